@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import time
+
+from signals import (
+    Fs,
+    resample,
+    render_rate,
+    write_temporary_sound,
+    play_sound_file,
+)
+from streams import (
+    Stream,
+    PlaybackClock,
+    ChunkLengthController,
+    WindowSorter,
+    chunk_target_length,
+)
+
+
+async def as_async(sounds, batch=64, executor=None):
+    """
+    Turns an ordinary (possibly slow) sound generator into an async one. The
+    generator is advanced in an executor a batch at a time, so expensive
+    synchronous stages do not block the event loop.
+    """
+    if hasattr(sounds, "__aiter__"):
+        async for sound in sounds:
+            yield sound
+        return
+
+    loop = asyncio.get_running_loop()
+    sounds = iter(sounds)
+    while True:
+        block = await loop.run_in_executor(
+            executor, list, itertools.islice(sounds, batch)
+        )
+        if not block:
+            return
+        for sound in block:
+            yield sound
+
+
+async def window_sort(sounds, window):
+    """Ensure that sounds are ordered within a window of seconds"""
+    sorter = WindowSorter(window)
+    async for sound in sounds:
+        for ready in sorter.push(sound):
+            yield ready
+    for sound in sorter.flush():
+        yield sound
+
+
+async def ensure_positive(sounds):
+    offset = None
+    async for sound in sounds:
+        if offset is None:
+            if sound.start < 0:
+                offset = -sound.start
+            else:
+                offset = 0
+
+        yield sound.delayed(offset)
+
+
+async def log_sounds(sounds):
+    async for sound in sounds:
+        print(sound)
+        yield sound
+
+
+async def chunk_ordered_sounds(sounds, length_break=4):
+    chunk = Stream()
+    chord_start = None
+    async for sound in sounds:
+        if chord_start is not None and sound.start_index() != chord_start:
+            if chunk.duration >= chunk_target_length(length_break):
+                yield chunk
+                chunk = Stream()
+
+        chunk.add_sound(sound)
+        chord_start = sound.start_index()
+
+    if not chunk.is_empty:
+        yield chunk
+
+
+def _render(stream, offset, Fs, render_Fs):
+    if stream.is_centered:
+        waveform = resample(stream.waveform(offset, render_Fs), render_Fs, Fs)
+        left, right = waveform, waveform
+    else:
+        left, right = resample(
+            stream.stereo_waveform(offset, render_Fs), render_Fs, Fs
+        )
+    return write_temporary_sound(left, right, Fs)
+
+
+async def play_streams(
+    streams, Fs=Fs, render_Fs=None, clock=None, executor=None, controller=None
+):
+    """
+    The event loop version of Stream.play_streams. Rendering and encoding
+    happen in an executor, and waiting for a deadline is an event loop timer,
+    so any number of players can share a single loop.
+    """
+    loop = asyncio.get_running_loop()
+    if render_Fs is None:
+        render_Fs = Fs
+    if clock is None:
+        clock = PlaybackClock(Fs, clock=loop.time)
+
+    offset = 0
+
+    audio_cleanup = None
+    async for stream in streams:
+        render_started = time.perf_counter()
+        filename = await loop.run_in_executor(
+            executor, _render, stream, offset, Fs, render_Fs
+        )
+        max_start = stream.max_start
+        if controller is not None:
+            controller.observe(
+                stream.duration, time.perf_counter() - render_started
+            )
+
+        if audio_cleanup is not None:
+            audio_cleanup()
+
+        position = round(offset * Fs)
+        if clock.started:
+            time_left = clock.time_until(position)
+            if time_left < 1:
+                print("less than one second left to wait")
+            if time_left > 0:
+                await asyncio.sleep(time_left)
+        else:
+            clock.start(position)
+        audio_cleanup = play_sound_file(filename)
+        clock.mark(position)
+
+        offset = max_start
+
+
+async def chunk_and_play(
+    sounds, length_break=4, quality="full", Fs=Fs, clock=None, executor=None
+):
+    controller = None
+    if isinstance(length_break, ChunkLengthController):
+        controller = length_break
+
+    await play_streams(
+        chunk_ordered_sounds(
+            as_async(sounds, executor=executor), length_break=length_break
+        ),
+        Fs=Fs,
+        render_Fs=render_rate(quality, Fs),
+        clock=clock,
+        executor=executor,
+        controller=controller,
+    )
+
+
+if __name__ == "__main__":
+    from sounds import Tone
+
+    def phrase(frequency, pan):
+        s = Stream()
+        for i in range(4):
+            s.add_sound(
+                Tone(
+                    start=i * 0.5,
+                    duration=0.4,
+                    frequency=frequency * (i + 1),
+                    overtones=[],
+                    volume=0.3,
+                    attack_seconds=0.05,
+                    decay_seconds=0.05,
+                    sustain_level=0.8,
+                    release_seconds=0.1,
+                    pan=pan,
+                )
+            )
+        return s
+
+    async def main():
+        await asyncio.gather(
+            chunk_and_play(phrase(220, -0.5).stream, length_break=0.5),
+            chunk_and_play(phrase(330, 0.5).stream, length_break=0.5),
+        )
+
+    asyncio.run(main())
@@ -0,0 +1,239 @@
+import random
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+import numpy as np
+
+from midi import build_stream_from_midi
+from infinite_gnossiennes_1 import sounds_to_key_and_stream
+from streams import Stream, StreamView
+
+
+def _ingest(filename, order):
+    """
+    Parses one MIDI file into its chords and the transition counts between
+    them, with chords numbered locally. Runs in a worker process.
+    """
+    stream = build_stream_from_midi(filename)
+
+    keys = {}
+    chords = []
+    counts = Counter()
+    history = deque(maxlen=order)
+    previous_start = None
+    for _, group in groupby(stream.stream, key=lambda sound: sound.start):
+        key, chord = sounds_to_key_and_stream(group)
+        start = chord.min_start
+        if key not in keys:
+            keys[key] = len(chords)
+            chords.append(
+                (key, [sound.delayed(-start) for sound in chord.stream])
+            )
+        chord_id = keys[key]
+
+        if previous_start is not None:
+            delta_t = round(start - previous_start, 6)
+            context = tuple(history)
+            for n in range(1, len(context) + 1):
+                counts[(context[-n:], chord_id, delta_t)] += 1
+
+        history.append(chord_id)
+        previous_start = start
+
+    return chords, counts
+
+
+class MarkovGraph(object):
+    """
+    A chord graph of any order, built from a corpus of pieces. Each chord
+    (a set of frequency, duration and volume triples, as in build_graph) is
+    numbered, and for every context of up to order chords the graph counts
+    which chord followed and after how long. Once frozen the counts are
+    packed into flat arrays, found through a dictionary keyed by the context
+    packed into a single integer, so large corpora stay compact and a step
+    of a walk is a dictionary lookup and a binary search.
+
+    Walks use the longest context that has been seen, falling back to
+    shorter ones.
+    """
+
+    def __init__(self, order=2):
+        if order < 1:
+            raise ValueError("order must be at least 1")
+        self._order = order
+        self._ids = {}
+        self._chords = []
+        self._counts = [Counter() for _ in range(order)]
+        self._index = None
+
+    @property
+    def order(self):
+        return self._order
+
+    @property
+    def chords(self):
+        return len(self._chords)
+
+    @property
+    def transitions(self):
+        if self._index is None:
+            return sum(len(counts) for counts in self._counts)
+        return len(self._next)
+
+    def chord(self, chord_id):
+        """The chord's sounds, as a Stream starting at zero"""
+        return self._chords[chord_id]
+
+    def _chord_id(self, key, sounds):
+        if key not in self._ids:
+            stream = Stream()
+            for sound in sounds:
+                stream.add_sound(sound)
+            self._ids[key] = len(self._chords)
+            self._chords.append(stream)
+        return self._ids[key]
+
+    def merge(self, chords, counts):
+        """Adds the chords and transition counts of one piece"""
+        if self._index is not None:
+            raise Exception("the graph is frozen")
+
+        ids = [self._chord_id(key, sounds) for key, sounds in chords]
+        for (context, chord_id, delta_t), count in counts.items():
+            context = tuple(ids[i] for i in context)
+            self._counts[len(context) - 1][
+                (context, ids[chord_id], delta_t)
+            ] += count
+
+    def _pack(self, context):
+        # a context of chord ids as a single int, shorter than a tuple
+        key = 0
+        for chord_id in context:
+            key = key * (len(self._chords) + 1) + chord_id + 1
+        return key
+
+    def freeze(self):
+        """Packs the counts into flat arrays for walking"""
+        if self._index is not None:
+            return
+
+        transitions = []
+        for counts in self._counts:
+            for (context, chord_id, delta_t), count in counts.items():
+                transitions.append(
+                    (self._pack(context), chord_id, delta_t, count)
+                )
+        transitions.sort(key=lambda transition: transition[0])
+
+        n = len(transitions)
+        self._next = np.fromiter((t[1] for t in transitions), np.int32, n)
+        self._delta = np.fromiter((t[2] for t in transitions), float, n)
+        self._cumulative = np.cumsum(
+            np.fromiter((t[3] for t in transitions), np.int64, n)
+        )
+
+        self._index = {}
+        start = 0
+        for key, group in groupby(t[0] for t in transitions):
+            end = start + sum(1 for _ in group)
+            self._index[key] = (start, end)
+            start = end
+        self._counts = None
+
+    def step(self, history, rng=random):
+        """
+        Picks the chord to follow the chord ids in history, and the time
+        until it, or returns None at a dead end.
+        """
+        self.freeze()
+        for n in range(min(self.order, len(history)), 0, -1):
+            found = self._index.get(self._pack(history[-n:]))
+            if found is None:
+                continue
+
+            start, end = found
+            low = self._cumulative[start - 1] if start else 0
+            r = low + rng.random() * (self._cumulative[end - 1] - low)
+            i = start + np.searchsorted(
+                self._cumulative[start:end], r, side="right"
+            )
+            i = min(i, end - 1)
+            return int(self._next[i]), float(self._delta[i])
+        return None
+
+    def walk(self, rng=random, timebase=None):
+        """Walks the graph forever, like walk_graph"""
+        self.freeze()
+
+        def steps(seconds):
+            if timebase is None:
+                return seconds
+            return round(seconds * timebase)
+
+        offset = 0
+        history = deque([rng.randrange(self.chords)], maxlen=self.order)
+
+        while True:
+            chord = self._chords[history[-1]]
+            yield from StreamView(chord, offset, timebase=timebase).stream
+
+            step = self.step(list(history), rng)
+            if step is not None:
+                chord_id, delta_t = step
+                offset += steps(delta_t)
+            else:
+                print("hit a dead end, starting from a random start")
+                offset += steps(5)
+                chord_id = rng.randrange(self.chords)
+                history.clear()
+            history.append(chord_id)
+
+
+def build_corpus_graph(filenames, order=2, processes=None):
+    """
+    Parses MIDI files in a pool of processes (or in this one if processes
+    is 1) and merges them into a single MarkovGraph. Files that cannot be
+    parsed are skipped.
+    """
+    graph = MarkovGraph(order)
+    filenames = list(filenames)
+    orders = [order] * len(filenames)
+
+    def merge(results):
+        for filename, result in zip(filenames, results):
+            if isinstance(result, Exception):
+                print(f"skipping {filename}: {result}", file=sys.stderr)
+            else:
+                graph.merge(*result)
+
+    if processes == 1:
+        merge(map(_try_ingest, filenames, orders))
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            merge(executor.map(_try_ingest, filenames, orders, chunksize=4))
+
+    graph.freeze()
+    return graph
+
+
+def _try_ingest(filename, order):
+    try:
+        return _ingest(filename, order)
+    except Exception as e:
+        return e
+
+
+if __name__ == "__main__":
+    import itertools
+
+    filenames = sys.argv[1:] or [
+        "gnossiennes_1.mid",
+        "satie_gnoissienne1.midi",
+        "cs1-1pre.mid",
+    ]
+    graph = build_corpus_graph(filenames, order=2)
+    print(f"{graph.chords} chords, {graph.transitions} transitions")
+    for sound in itertools.islice(graph.walk(), 20):
+        print(sound)
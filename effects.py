@@ -0,0 +1,314 @@
+import numpy as np
+
+from signals import Fs, n_samples, read_sound, resample
+
+
+class Convolver(object):
+    """
+    Streaming convolution with an impulse response, using uniformly
+    partitioned FFT convolution. The impulse response is split into
+    partitions of block_size samples whose spectra are computed once, and
+    every input block costs one forward FFT, one inverse FFT and a
+    multiply-accumulate against the spectra of the recent input blocks, no
+    matter how the input is chunked.
+
+    Input of any length can be processed; output is delayed by block_size
+    samples so that only whole blocks ever go through the FFTs.
+    """
+
+    def __init__(self, impulse_response, block_size=512):
+        impulse_response = np.atleast_2d(impulse_response)
+        self._block_size = block_size
+        self._fft_size = 2 * block_size
+        self._ir_length = impulse_response.shape[1]
+
+        partitions = -(-self._ir_length // block_size)
+        padded = np.zeros(
+            (impulse_response.shape[0], partitions * block_size)
+        )
+        padded[:, : self._ir_length] = impulse_response
+        self._spectra = np.fft.rfft(
+            padded.reshape((len(impulse_response), partitions, block_size)),
+            n=self._fft_size,
+        )
+
+        self._channels = None
+        self._channel_spectra = None
+        self._history = None
+        self._head = 0
+        self._previous = None
+        self._pending = None
+        self._output = None
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def latency(self):
+        return self._block_size
+
+    @property
+    def tail_length(self):
+        """Samples of output still to come after the input goes silent"""
+        return self._ir_length - 1 + self.latency
+
+    def reset(self, channels):
+        partitions, bins = self._spectra.shape[1:]
+        self._channels = channels
+        self._channel_spectra = np.broadcast_to(
+            self._spectra, (channels, partitions, bins)
+        )
+        self._history = np.zeros((channels, partitions, bins), dtype=complex)
+        self._head = 0
+        self._previous = np.zeros((channels, self._block_size))
+        self._pending = np.zeros((channels, 0))
+        self._output = np.zeros((channels, self._block_size))
+
+    def _convolve_block(self, block):
+        # overlap-save: transform the previous and current input blocks
+        # together and keep the second half of the circular result
+        spectrum = np.fft.rfft(
+            np.hstack((self._previous, block)), n=self._fft_size
+        )
+        self._previous = block
+
+        # the history is a ring, newest first from head, so each partition's
+        # spectrum lines up with the input from that many blocks ago in two
+        # slices rather than by moving the whole history along
+        partitions = self._history.shape[1]
+        head = self._head = (self._head - 1) % partitions
+        self._history[:, head] = spectrum
+        tail = partitions - head
+        accumulated = np.einsum(
+            "cpb,cpb->cb",
+            self._history[:, head:],
+            self._channel_spectra[:, :tail],
+        )
+        if head:
+            accumulated += np.einsum(
+                "cpb,cpb->cb",
+                self._history[:, :head],
+                self._channel_spectra[:, tail:],
+            )
+        return np.fft.irfft(accumulated, n=self._fft_size)[
+            :, self._block_size :
+        ]
+
+    def process(self, samples):
+        """
+        Takes a channels x N (or mono) block of samples and returns the same
+        shape, with the filter state carried over between calls.
+        """
+        mono = samples.ndim == 1
+        samples = np.atleast_2d(samples)
+        if self._channels != samples.shape[0]:
+            self.reset(samples.shape[0])
+
+        self._pending = np.hstack((self._pending, samples))
+        blocks = [self._output]
+        while self._pending.shape[1] >= self._block_size:
+            block = self._pending[:, : self._block_size]
+            self._pending = self._pending[:, self._block_size :]
+            blocks.append(self._convolve_block(block))
+
+        output = np.hstack(blocks)
+        result = output[:, : samples.shape[1]]
+        self._output = output[:, samples.shape[1] :]
+        return result[0] if mono else result
+
+
+def lowpass_taps(cutoff, num_taps=255, Fs=Fs):
+    """A Hann windowed sinc low pass filter"""
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff / Fs * n) * np.hanning(num_taps)
+    return taps / np.sum(taps)
+
+
+def highpass_taps(cutoff, num_taps=255, Fs=Fs):
+    """Spectral inversion of the low pass filter, num_taps must be odd"""
+    taps = -lowpass_taps(cutoff, num_taps, Fs)
+    taps[(num_taps - 1) // 2] += 1
+    return taps
+
+
+def load_impulse_response(filename, Fs=Fs, normalize=True):
+    impulse_response, file_Fs = read_sound(filename)
+    impulse_response = resample(impulse_response, file_Fs, Fs)
+    if normalize:
+        # scale so that the response has unit energy per channel
+        energy = np.sqrt(
+            np.sum(impulse_response ** 2, axis=1, keepdims=True)
+        )
+        impulse_response = impulse_response / np.where(energy, energy, 1)
+    return impulse_response
+
+
+class FirFilter(Convolver):
+    def __init__(self, taps, block_size=512):
+        super().__init__(taps, block_size)
+
+
+class Reverb(object):
+    """Convolution reverb with a dry/wet mix, the dry path is delay matched"""
+
+    def __init__(self, impulse_response, wet=0.3, block_size=512):
+        self._convolver = Convolver(impulse_response, block_size)
+        self._wet = wet
+        self._dry_delay = None
+
+    @classmethod
+    def from_file(cls, filename, wet=0.3, block_size=512, Fs=Fs):
+        return cls(load_impulse_response(filename, Fs), wet, block_size)
+
+    @property
+    def latency(self):
+        return self._convolver.latency
+
+    @property
+    def tail_length(self):
+        return self._convolver.tail_length
+
+    def process(self, samples):
+        mono = samples.ndim == 1
+        samples = np.atleast_2d(samples)
+        if self._dry_delay is None or len(self._dry_delay) != len(samples):
+            self._dry_delay = np.zeros((samples.shape[0], self.latency))
+
+        delayed = np.hstack((self._dry_delay, samples))
+        self._dry_delay = delayed[:, samples.shape[1] :]
+        wet = self._convolver.process(samples)
+
+        result = (1 - self._wet) * delayed[:, : samples.shape[1]] + (
+            self._wet * wet
+        )
+        return result[0] if mono else result
+
+
+def _sliding_min(values, width):
+    """
+    The minimum of every window of width values, in linear time: the
+    minimum of a window is the smaller of a suffix minimum and a prefix
+    minimum of the width-long blocks it straddles.
+    """
+    count = len(values) - width + 1
+    blocks = -(-len(values) // width)
+    padded = np.full(blocks * width, np.inf)
+    padded[: len(values)] = values
+    padded = padded.reshape((blocks, width))
+
+    prefix = np.minimum.accumulate(padded, axis=1).ravel()
+    suffix = np.minimum.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.minimum(suffix[:count], prefix[width - 1 : width - 1 + count])
+
+
+class Limiter(object):
+    """
+    A lookahead peak limiter. The gain needed to keep every sample within
+    the ceiling is found lookahead seconds in advance, held for hold
+    seconds and smoothed into linear ramps lookahead long, so the gain is
+    already down when a peak arrives and never has to jump. Gain state is
+    carried between calls, so blocks of any size can be streamed through it
+    on the way to the PCM encoder.
+
+    Output is delayed by the lookahead.
+    """
+
+    def __init__(self, lookahead=0.005, hold=0.05, ceiling=1.0, Fs=Fs):
+        self._lookahead = max(n_samples(lookahead, Fs), 1)
+        self._hold = n_samples(hold, Fs)
+        self._ceiling = ceiling
+        self._channels = None
+        self._pending = None
+        self._ratios = None
+        self._gains = None
+        self._reduction = 1.0
+
+    @property
+    def latency(self):
+        return self._lookahead
+
+    @property
+    def tail_length(self):
+        return self.latency
+
+    @property
+    def ceiling(self):
+        return self._ceiling
+
+    @property
+    def reduction(self):
+        """The smallest gain applied so far"""
+        return self._reduction
+
+    def reset(self, channels):
+        lookahead = self._lookahead
+        self._channels = channels
+        # the input waiting to come out, as far as the lookahead reaches
+        self._pending = np.zeros((channels, lookahead))
+        # the gain each sample needs, from as far back as the hold and the
+        # smoothing reach, up to the newest input
+        self._ratios = np.ones(self._hold + 2 * lookahead)
+
+    def process(self, samples):
+        """
+        Takes a channels x N (or mono) block of samples and returns the same
+        shape, delayed by the latency.
+        """
+        mono = samples.ndim == 1
+        samples = np.atleast_2d(samples)
+        if self._channels != samples.shape[0]:
+            self.reset(samples.shape[0])
+
+        length = samples.shape[1]
+        lookahead = self._lookahead
+
+        peaks = np.max(np.abs(samples), axis=0)
+        ratios = np.concatenate(
+            (
+                self._ratios,
+                self.ceiling / np.maximum(peaks, self.ceiling),
+            )
+        )
+
+        # the lowest ratio from hold samples back to lookahead samples ahead
+        # of every sample, then a lookahead long moving average of that;
+        # every window of the average covers its own sample, so the result
+        # never exceeds the ratio that sample needs
+        held = _sliding_min(ratios, self._hold + lookahead + 1)
+        summed = np.concatenate(([0.0], np.cumsum(held)))
+        gains = (
+            summed[lookahead + 1 :] - summed[: length]
+        ) / (lookahead + 1)
+
+        delayed = np.hstack((self._pending, samples))
+        result = delayed[:, :length] * gains
+        self._pending = delayed[:, length:]
+        self._ratios = ratios[length:]
+        if length:
+            self._reduction = min(self._reduction, float(np.min(gains)))
+        return result[0] if mono else result
+
+
+class EffectsBus(object):
+    """A chain of block effects applied, in order, to the mixed output"""
+
+    def __init__(self, *effects):
+        self._effects = list(effects)
+
+    @property
+    def effects(self):
+        return self._effects
+
+    @property
+    def latency(self):
+        return sum(effect.latency for effect in self.effects)
+
+    @property
+    def tail_length(self):
+        return sum(effect.tail_length for effect in self.effects)
+
+    def process(self, samples):
+        for effect in self.effects:
+            samples = effect.process(samples)
+        return samples
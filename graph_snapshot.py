@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+
+from infinite_gnossiennes_1 import Node, Edge, build_graph
+from sounds import Tone, Overtone
+from streams import Stream
+from midi import build_stream_from_midi
+
+# A snapshot is the magic number, a version, the length of a JSON header
+# describing the tables, the header itself and then the tables as raw
+# arrays, each aligned so that it can be memory mapped in place.
+MAGIC = b"TWGRAPH\0"
+VERSION = 1
+ALIGNMENT = 64
+
+# recorded in snapshots built from a MIDI file; bump it whenever build_graph
+# or the MIDI parser change what they build, so old snapshots are rebuilt
+BUILD_VERSION = 1
+
+SOUND_DTYPE = np.dtype(
+    [
+        ("start", "<f8"),
+        ("duration", "<f8"),
+        ("frequency", "<f8"),
+        ("volume", "<f8"),
+        ("attack_seconds", "<f8"),
+        ("decay_seconds", "<f8"),
+        ("sustain_level", "<f8"),
+        ("release_seconds", "<f8"),
+        ("pan", "<f8"),
+        ("overtone_start", "<i4"),
+        ("overtone_count", "<i4"),
+    ]
+)
+OVERTONE_DTYPE = np.dtype(
+    [
+        ("frequency_multiplier", "<f8"),
+        ("phase_shift", "<f8"),
+        ("amplitude", "<f8"),
+    ]
+)
+NODE_DTYPE = np.dtype(
+    [
+        ("sound_start", "<i4"),
+        ("sound_count", "<i4"),
+        ("edge_start", "<i4"),
+        ("edge_count", "<i4"),
+    ]
+)
+EDGE_DTYPE = np.dtype(
+    [("delta_t", "<f8"), ("target", "<i4"), ("weight", "<i4")]
+)
+
+
+def _tables(graph):
+    index = {key: i for i, key in enumerate(graph)}
+    nodes, sounds, overtones, edges = [], [], [], []
+    overtone_lists = {}
+    timebase = None
+
+    for key, node in graph.items():
+        sound_start = len(sounds)
+        for sound in node.stream.stream:
+            if not isinstance(sound, Tone):
+                raise Exception("only graphs of Tones can be saved")
+            if sound.timebase is not None:
+                timebase = sound.timebase
+
+            partials = tuple(sound.overtones)
+            if partials not in overtone_lists:
+                overtone_lists[partials] = len(overtones)
+                overtones.extend(partials)
+
+            sounds.append(
+                (
+                    sound.start,
+                    sound.duration,
+                    sound.frequency,
+                    sound.volume,
+                    sound.attack_seconds,
+                    sound.decay_seconds,
+                    sound.sustain_level,
+                    sound.release_seconds,
+                    sound.pan,
+                    overtone_lists[partials],
+                    len(partials),
+                )
+            )
+
+        # repeated edges become a single weighted one
+        weights = {}
+        for edge in node.edges:
+            target = (index[edge.key], edge.delta_t)
+            weights[target] = weights.get(target, 0) + 1
+        edge_start = len(edges)
+        for (target, delta_t), weight in weights.items():
+            edges.append((delta_t, target, weight))
+
+        nodes.append(
+            (
+                sound_start,
+                len(sounds) - sound_start,
+                edge_start,
+                len(edges) - edge_start,
+            )
+        )
+
+    tables = {
+        "nodes": np.array(nodes, dtype=NODE_DTYPE),
+        "sounds": np.array(sounds, dtype=SOUND_DTYPE),
+        "overtones": np.array(overtones, dtype=OVERTONE_DTYPE),
+        "edges": np.array(edges, dtype=EDGE_DTYPE),
+    }
+    return tables, timebase
+
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def _tables_offset(header_length):
+    return _aligned(len(MAGIC) + 8 + header_length)
+
+
+def _dtype(descr):
+    # JSON turns the descr's tuples into lists
+    if isinstance(descr, list):
+        descr = [tuple(field) for field in descr]
+    return np.lib.format.descr_to_dtype(descr)
+
+
+def _source_stamp(source):
+    # by content, so that a snapshot copied along with its MIDI file stays
+    # current
+    with open(source, "rb") as f:
+        contents = f.read()
+    return {
+        "size": len(contents),
+        "sha256": hashlib.sha256(contents).hexdigest(),
+        "build": BUILD_VERSION,
+    }
+
+
+def _read_header(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a graph snapshot")
+        version, header_length = struct.unpack("<II", f.read(8))
+        if version != VERSION:
+            raise ValueError(f"unsupported graph snapshot version {version}")
+        return json.loads(f.read(header_length)), header_length
+
+
+def save_graph(graph, filename, source=None):
+    """
+    Saves a graph from build_graph. Edges that appear more than once are
+    stored once with a weight. If the graph was built from a source file,
+    the file is recorded so that snapshot_is_current can tell when the
+    snapshot has gone stale.
+    """
+    tables, timebase = _tables(graph)
+
+    # table offsets are relative to the end of the header
+    header = {
+        "timebase": timebase,
+        "source": None if source is None else _source_stamp(source),
+        "tables": {},
+    }
+    position = 0
+    for name, table in tables.items():
+        header["tables"][name] = {
+            "dtype": np.lib.format.dtype_to_descr(table.dtype),
+            "length": len(table),
+            "offset": position,
+        }
+        position = _aligned(position + table.nbytes)
+
+    encoded = json.dumps(header).encode()
+    base = _tables_offset(len(encoded))
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", VERSION, len(encoded)))
+        f.write(encoded)
+        for name, table in tables.items():
+            f.seek(base + header["tables"][name]["offset"])
+            f.write(table.tobytes())
+
+
+class GraphSnapshot(Mapping):
+    """
+    A graph loaded from a snapshot. It maps node numbers to Nodes just as
+    build_graph's graphs map chord keys to them, so walk_graph can walk it.
+    The tables are memory mapped and nodes are only built when visited, so
+    loading takes the same time however big the graph is.
+    """
+
+    def __init__(self, filename):
+        header, header_length = _read_header(filename)
+
+        self._timebase = header["timebase"]
+        base = _tables_offset(header_length)
+        tables = {}
+        for name, layout in header["tables"].items():
+            dtype = _dtype(layout["dtype"])
+            if layout["length"] == 0:
+                # an empty file region cannot be mapped
+                tables[name] = np.zeros(0, dtype=dtype)
+                continue
+            tables[name] = np.memmap(
+                filename,
+                dtype=dtype,
+                mode="r",
+                offset=base + layout["offset"],
+                shape=(layout["length"],),
+            )
+        self._nodes = tables["nodes"]
+        self._sounds = tables["sounds"]
+        self._overtones = tables["overtones"]
+        self._edges = tables["edges"]
+        self._built = {}
+        self._overtone_lists = {}
+
+    @property
+    def timebase(self):
+        return self._timebase
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(range(len(self._nodes)))
+
+    def __getitem__(self, key):
+        if key not in self._built:
+            if not 0 <= key < len(self._nodes):
+                raise KeyError(key)
+            self._built[key] = self._node(key)
+        return self._built[key]
+
+    def _overtone_list(self, start, count):
+        # tones share their overtone lists, as they do when built from MIDI
+        if (start, count) not in self._overtone_lists:
+            self._overtone_lists[(start, count)] = [
+                Overtone(*map(float, row))
+                for row in self._overtones[start : start + count]
+            ]
+        return self._overtone_lists[(start, count)]
+
+    def _node(self, key):
+        sound_start, sound_count, edge_start, edge_count = map(
+            int, self._nodes[key]
+        )
+
+        stream = Stream()
+        for row in self._sounds[sound_start : sound_start + sound_count]:
+            start, duration = float(row["start"]), float(row["duration"])
+            if self.timebase is not None:
+                start = round(start * self.timebase)
+                duration = round(duration * self.timebase)
+            stream.add_sound(
+                Tone(
+                    start,
+                    duration,
+                    float(row["frequency"]),
+                    self._overtone_list(
+                        int(row["overtone_start"]), int(row["overtone_count"])
+                    ),
+                    float(row["volume"]),
+                    float(row["attack_seconds"]),
+                    float(row["decay_seconds"]),
+                    float(row["sustain_level"]),
+                    float(row["release_seconds"]),
+                    float(row["pan"]),
+                    self.timebase,
+                )
+            )
+
+        # walk_graph picks edges uniformly, so weights become repeats
+        edges = []
+        for delta_t, target, weight in self._edges[
+            edge_start : edge_start + edge_count
+        ]:
+            edges.extend([Edge(float(delta_t), int(target))] * int(weight))
+
+        return Node(stream=stream, edges=edges)
+
+
+def load_graph(filename):
+    return GraphSnapshot(filename)
+
+
+def snapshot_is_current(filename, source, timebase=None):
+    """
+    Whether filename is a snapshot of the graph build_graph would build from
+    the MIDI file source with timebase: built from a file with the same
+    contents by the same version of the build.
+    """
+    try:
+        header, _ = _read_header(filename)
+        stamp = _source_stamp(source)
+    except (OSError, ValueError):
+        return False
+    return header.get("source") == stamp and header["timebase"] == timebase
+
+
+def cached_graph(source, filename, timebase=None):
+    """
+    Loads the graph of the MIDI file source from the snapshot filename,
+    building it and saving the snapshot first if it is missing or stale.
+    Without the MIDI file an existing snapshot is loaded as it is.
+    """
+    if not os.path.exists(source):
+        return load_graph(filename)
+    if not snapshot_is_current(filename, source, timebase):
+        stream = build_stream_from_midi(source)
+        save_graph(build_graph(stream.stream, timebase), filename, source)
+    return load_graph(filename)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    midi_file = sys.argv[1] if len(sys.argv) > 1 else "gnossiennes_1.mid"
+    snapshot = sys.argv[2] if len(sys.argv) > 2 else "gnossiennes_1.graph"
+
+    started = time.perf_counter()
+    graph = build_graph(build_stream_from_midi(midi_file).stream)
+    print(f"built {len(graph)} nodes in {time.perf_counter() - started:.3f}s")
+
+    save_graph(graph, snapshot, midi_file)
+
+    started = time.perf_counter()
+    loaded = load_graph(snapshot)
+    elapsed = time.perf_counter() - started
+    print(f"loaded {len(loaded)} nodes in {elapsed:.4f}s")
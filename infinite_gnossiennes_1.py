@@ -2,11 +2,7 @@ from itertools import groupby, islice
 from collections import namedtuple
 import random
 
-import console
-import sound
-
-from midi import build_stream_from_midi
-from streams import chunk_and_play, Stream
+from streams import chunk_and_play, Stream, StreamView
 from signals import prevent_device_sleep
 
 
@@ -31,16 +27,26 @@ def sounds_to_key_and_stream(sounds):
     return frozenset(key), stream
 
 
-def build_graph(sounds):
+def build_graph(sounds, timebase=None):
+    """
+    Builds a graph of the chords in sounds and the steps between them. With
+    a timebase the chords are quantized to integer sample positions at that
+    rate, to be walked with the same timebase.
+    """
     graph = {}
 
     previous_key, previous_stream = None, None
     for _, group in groupby(sounds, key=lambda sound: sound.start):
         key, stream = sounds_to_key_and_stream(group)
+        if timebase is not None:
+            stream = stream.quantized(timebase)
 
         if key not in graph.keys():
+            start = stream.min_start
+            if timebase is not None:
+                start = round(start * timebase)
             graph[key] = Node(
-                stream=stream.delayed(-stream.min_start), edges=[]
+                stream=StreamView(stream, -start, timebase=timebase), edges=[]
             )
 
         if previous_key is not None:
@@ -56,38 +62,48 @@ def build_graph(sounds):
     return graph
 
 
-def walk_graph(graph):
+def walk_graph(graph, rng=random, timebase=None):
+    """
+    Walks the graph forever. With a timebase the position of the walk is
+    kept as a whole number of samples at that rate, so that it does not
+    lose precision however long the walk goes on.
+    """
+
+    def steps(seconds):
+        if timebase is None:
+            return seconds
+        return round(seconds * timebase)
+
     offset = 0
-    key = random.choice(list(graph.keys()))
+    key = rng.choice(list(graph.keys()))
 
     while True:
-        yield from graph[key].stream.delayed(offset).stream
+        node = graph[key]
+        yield from StreamView(node.stream, offset, timebase=timebase).stream
 
-        if graph[key].edges:
-            edge = random.choice(graph[key].edges)
-            offset += edge.delta_t
+        if node.edges:
+            edge = rng.choice(node.edges)
+            offset += steps(edge.delta_t)
             key = edge.key
         else:
             print("hit a dead end, starting from a random start")
-            offset += 5
-            key = random.choice(list(graph.keys()))
+            offset += steps(5)
+            key = rng.choice(list(graph.keys()))
 
 
 if __name__ == "__main__":
+    import console
+    import sound
+
+    from graph_snapshot import cached_graph
+
     console.clear()
     sound.stop_all_effects()
 
-    gnossiennes = build_stream_from_midi("gnossiennes_1.mid")
-
-    graph = build_graph(gnossiennes.stream)
-    print(len(graph))
-    for key, node in graph.items():
-        print(key)
-        for sound in node.stream.stream:
-            print(sound)
-        print(node.edges)
-        print()
+    # the graph is built once and then loaded from its snapshot, until the
+    # MIDI file changes
+    graph = cached_graph("gnossiennes_1.mid", "gnossiennes_1.graph")
+    print(f"{len(graph)} nodes")
 
     with prevent_device_sleep():
         chunk_and_play(walk_graph(graph))
-
@@ -0,0 +1,204 @@
+import math
+
+import numpy as np
+
+# Numba is optional. With it, a Tone is synthesized in a single compiled loop
+# that computes each sample (oscillators, overtones and envelope) and adds it
+# straight into the mix buffer; without it the NumPy rendering in sounds.py is
+# used as before.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from signals import Fs
+
+
+def _add_tone(
+    out,
+    start_index,
+    total_samples,
+    duration,
+    frequency,
+    multipliers,
+    phase_shifts,
+    amplitudes,
+    volume,
+    sustain_level,
+    attack_samples,
+    decay_samples,
+    release_samples,
+    gains,
+):
+    # the envelope segments mirror np.linspace so that the result matches
+    # Tone.waveform_source to rounding error. Rather than calling sin for
+    # every partial of every sample, each partial is a phasor that is
+    # rotated by one time step per sample.
+    time_step = duration / (total_samples - 1) if total_samples > 1 else 0.0
+    sustain = volume * sustain_level
+    decay_start = attack_samples
+    sustain_start = attack_samples + decay_samples
+    release_start = total_samples - release_samples
+
+    partials = len(multipliers) + 1
+    weights = np.empty(partials)
+    real = np.empty(partials)
+    imaginary = np.empty(partials)
+    rotate_real = np.empty(partials)
+    rotate_imaginary = np.empty(partials)
+    for k in range(partials):
+        if k == 0:
+            angular, phase, weights[k] = 2.0 * math.pi * frequency, 0.0, 1.0
+        else:
+            angular = 2.0 * math.pi * (multipliers[k - 1] * frequency)
+            phase, weights[k] = phase_shifts[k - 1], amplitudes[k - 1]
+        real[k], imaginary[k] = math.cos(phase), math.sin(phase)
+        rotate_real[k] = math.cos(angular * time_step)
+        rotate_imaginary[k] = math.sin(angular * time_step)
+
+    for i in range(total_samples):
+        value = 0.0
+        for k in range(partials):
+            value += weights[k] * imaginary[k]
+            r = real[k] * rotate_real[k] - imaginary[k] * rotate_imaginary[k]
+            imaginary[k] = (
+                real[k] * rotate_imaginary[k] + imaginary[k] * rotate_real[k]
+            )
+            real[k] = r
+
+        if i < decay_start:
+            envelope = _segment(0.0, volume, i, attack_samples)
+        elif i < sustain_start:
+            envelope = _segment(
+                volume, sustain, i - decay_start, decay_samples
+            )
+        elif i < release_start:
+            envelope = sustain
+        else:
+            envelope = _segment(
+                sustain, 0.0, i - release_start, release_samples
+            )
+
+        value *= envelope
+        for c in range(len(gains)):
+            out[c, start_index + i] += gains[c] * value
+
+
+def _segment(start, stop, i, count):
+    # matches np.linspace, which gives just the start for a single sample
+    if count == 1:
+        return start
+    if i == count - 1:
+        return stop
+    return start + i * ((stop - start) / (count - 1))
+
+
+if njit is not None:
+    _segment = njit(cache=True)(_segment)
+    _add_tone_kernel = njit(cache=True)(_add_tone)
+    BACKEND = "numba"
+else:
+    _add_tone_kernel = None
+    BACKEND = "numpy"
+
+
+def use_backend(backend):
+    """Switches between "numba" (if installed) and "numpy" rendering"""
+    global BACKEND
+    if backend == "numba" and _add_tone_kernel is None:
+        raise ValueError("numba is not installed")
+    if backend not in ("numba", "numpy"):
+        raise ValueError(f"unknown backend: {backend}")
+    BACKEND = backend
+
+
+def add_tone_into(out, start_index, tone, gains, total_samples, phases):
+    """
+    Accumulates a tone into the channels of out (a channels x N float array)
+    with the compiled kernel. phases are the tone's attack, decay and release
+    lengths in samples.
+    """
+    overtones = tone.overtones
+    _add_tone_kernel(
+        out,
+        start_index,
+        total_samples,
+        float(tone.duration),
+        float(tone.frequency),
+        np.array([o.frequency_multiplier for o in overtones], dtype=float),
+        np.array([o.phase_shift for o in overtones], dtype=float),
+        np.array([o.amplitude for o in overtones], dtype=float),
+        float(tone.volume),
+        float(tone.sustain_level),
+        phases[0],
+        phases[1],
+        phases[2],
+        np.array(gains, dtype=float),
+    )
+
+
+def check_kernels(tolerance=1e-8, Fs=Fs):
+    """
+    Renders a handful of tones with both backends and returns the largest
+    difference, raising if it is beyond the tolerance.
+    """
+    from numpy import pi
+
+    from sounds import Tone, Overtone
+
+    if _add_tone_kernel is None:
+        raise ValueError("numba is not installed")
+
+    tones = [
+        Tone(0, 1, 440, [], 0.5, 0.1, 0.1, 0.5, 0.1),
+        Tone(0.25, 0.05, 880, [], 0.3, 0.1, 0.1, 0.5, 0.1),
+        Tone(
+            0.5,
+            2.3,
+            123.4,
+            [Overtone(2, 0.5 * pi, 0.5), Overtone(3, 0, 0.3)],
+            0.4,
+            0.2,
+            0.05,
+            0.75,
+            0.3,
+            pan=0.5,
+        ),
+        Tone(1, 1 / Fs, 200, [], 0.5, 0.1, 0.1, 0.5, 0.1),
+    ]
+    # tones a few samples long, as polyphony cuts and stretching leave,
+    # shrink their envelope phases down to single samples
+    tones.extend(
+        Tone(1.5, samples / Fs, 300, [], 0.5, 0.1, 0.1, 0.5, 0.1)
+        for samples in range(2, 8)
+    )
+
+    worst = 0.0
+    previous = BACKEND
+    try:
+        for tone in tones:
+            start_index = round(tone.start * Fs)
+            length = start_index + len(tone.rendered(Fs))
+            results = []
+            for backend in ("numpy", "numba"):
+                use_backend(backend)
+                out = np.zeros((2, length))
+                tone.add_into(out, start_index, tone.channel_gains, Fs)
+                results.append(out)
+            difference = np.max(np.abs(results[0] - results[1]))
+            worst = max(worst, float(difference))
+    finally:
+        use_backend(previous)
+
+    if worst > tolerance:
+        raise AssertionError(f"kernels differ by {worst}")
+    return worst
+
+
+if __name__ == "__main__":
+    # sounds uses the imported module rather than __main__, so the backend
+    # has to be switched there
+    import kernels
+
+    print(f"backend: {kernels.BACKEND}")
+    print(f"largest difference: {kernels.check_kernels()}")
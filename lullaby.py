@@ -5,6 +5,7 @@ import tempfile
 import os
 import random
 import functools
+import operator
 
 import numpy as np
 
@@ -18,7 +19,9 @@ from streams import (
 )
 from sounds import Tone
 from signals import prevent_device_sleep
-from notes import scientific_note_frequency, add_cents
+from notes import scientific_note_frequency, cents_ratio
+from pipeline import Pipeline, in_place
+from profiler import Profiler
 
 
 twinkle_twinkle_little_star_notes = [
@@ -57,49 +60,50 @@ for phrase in twinkle_twinkle_little_star_notes:
         current_time += duration
 
 
-def fuzzy_start(sounds):
-    for sound in sounds:
-        yield sound.delayed(
-            random.uniform(-note_length / 32.0, note_length / 32.0)
-        )
+@in_place
+def fuzzy_start(sound):
+    sound.delay(random.uniform(-note_length / 32.0, note_length / 32.0))
 
 
-def fuzzy_duration(sounds):
-    for sound in sounds:
-        yield sound.stretched(random.uniform(0.9, 1.1))
+@in_place
+def fuzzy_duration(sound):
+    sound.stretch(random.uniform(0.9, 1.1))
 
 
-def detune(tones):
-    for tone in tones:
-        yield tone.detuned(
-            functools.partial(add_cents, random.randint(-50, 50))
-        )
+detune_ratios = cents_ratio(np.arange(-50, 51))
+
+
+@in_place
+def detune(tone):
+    ratio = float(random.choice(detune_ratios))
+    tone.detune(functools.partial(operator.mul, ratio))
 
 
 loop, tap = make_loop_and_tap()
 
+# set LULLABY_TRACE to a filename to profile the pipeline and playback
+trace_filename = os.environ.get("LULLABY_TRACE")
+profiler = Profiler(enabled=trace_filename is not None)
 
-with prevent_device_sleep():
-    chunk_and_play(
-        log_sounds(
-            window_sort(
-                ensure_positive(
-                    fuzzy_duration(
-                        fuzzy_start(
-                            detune(
-                                tap(
-                                    loop(
-                                        twinkle_twinkle_little_star.stream,
-                                        loops=float("inf"),
-                                        gap=0.1,
-                                    )
-                                )
-                            )
-                        )
-                    )
-                ),
-                3,
-            )
-        )
-    )
+lullaby = Pipeline(
+    functools.partial(loop, loops=float("inf"), gap=0.1),
+    tap,
+    detune,
+    fuzzy_start,
+    fuzzy_duration,
+    ensure_positive,
+    functools.partial(window_sort, window=3),
+    log_sounds,
+    profiler=profiler,
+)
 
+
+try:
+    with prevent_device_sleep():
+        chunk_and_play(
+            lullaby(twinkle_twinkle_little_star.stream), profiler=profiler
+        )
+finally:
+    if profiler.enabled:
+        profiler.report()
+        profiler.write_trace(trace_filename)
@@ -4,12 +4,12 @@ import functools
 
 from numpy import pi
 
-from streams import Stream, chunk_and_play
+from streams import Stream
 from sounds import Tone, Overtone
-from notes import midi_note_frequency
+from notes import EQUAL_TEMPERAMENT
 
 
-def build_stream_from_midi(filename):
+def build_stream_from_midi(filename, tuning=EQUAL_TEMPERAMENT):
     mid = mido.MidiFile(filename)
     merged_tracks = mido.merge_tracks(mid.tracks)
 
@@ -24,6 +24,9 @@ def build_stream_from_midi(filename):
     }
 
     stream = Stream()
+    # (start, duration, note, velocity) of every finished note, turned into
+    # tones in one go at the end so the frequencies come from a single lookup
+    finished_notes = []
 
     for msg in merged_tracks:
         if msg.type == "note_on" and msg.velocity == 0:
@@ -68,23 +71,8 @@ def build_stream_from_midi(filename):
             duration = current_time - started
             if duration > 5:
                 raise Exception(f"would have created a very long note: {msg}")
-            stream.add_sound(
-                Tone(
-                    start=started,
-                    duration=duration,
-                    frequency=midi_note_frequency(msg.note),
-                    overtones=[
-                        Overtone(2, 0.5 * pi, 0.5),
-                        Overtone(3, 0, 0.3),
-                        Overtone(4, 0.25 * pi, 0.2),
-                        Overtone(5, 0, 0.2),
-                    ],
-                    volume=0.4 * initial_velocity / 127,
-                    attack_seconds=0.1,
-                    decay_seconds=0.1,
-                    sustain_level=0.75,
-                    release_seconds=0.1,
-                )
+            finished_notes.append(
+                (started, duration, msg.note, initial_velocity)
             )
 
         elif msg.type in (
@@ -102,6 +90,31 @@ def build_stream_from_midi(filename):
         else:
             raise Exception(f"unkown message: {msg}")
 
+    frequencies = tuning.frequencies_of(
+        [note for _, _, note, _ in finished_notes]
+    )
+    for (started, duration, _, initial_velocity), frequency in zip(
+        finished_notes, frequencies
+    ):
+        stream.add_sound(
+            Tone(
+                start=started,
+                duration=duration,
+                frequency=float(frequency),
+                overtones=[
+                    Overtone(2, 0.5 * pi, 0.5),
+                    Overtone(3, 0, 0.3),
+                    Overtone(4, 0.25 * pi, 0.2),
+                    Overtone(5, 0, 0.2),
+                ],
+                volume=0.4 * initial_velocity / 127,
+                attack_seconds=0.1,
+                decay_seconds=0.1,
+                sustain_level=0.75,
+                release_seconds=0.1,
+            )
+        )
+
     return stream
 
 
@@ -124,5 +137,13 @@ if __name__ == "__main__":
     stream = build_stream_from_midi("satie_gnoissienne1.midi")
     stream = build_stream_from_midi("cs1-1pre.mid")
     #stream = build_stream_from_midi("gnossiennes_1.mid")
-    chunk_and_play(stream.stream, length_break=10)
+
+    # dense passages sum past full scale, so the mix goes through a limiter
+    # rather than being clipped when it is encoded
+    from effects import EffectsBus, Limiter
+    from mixer import Mixer
+
+    mixer = Mixer(block_length=10, effects=EffectsBus(Limiter()))
+    mixer.add_layer(stream.stream)
+    mixer.play()
 
@@ -0,0 +1,189 @@
+import itertools
+import threading
+
+import numpy as np
+
+from signals import Fs, n_samples, write_temporary_sound, play_sound_file
+from streams import PlaybackClock
+
+
+class Layer(object):
+    def __init__(self, sounds, gain, start_position):
+        self._sounds = iter(sounds)
+        self._gain = gain
+        self._start_position = start_position
+        self._next = None
+        self._exhausted = False
+
+    @property
+    def gain(self):
+        return self._gain
+
+    def set_gain(self, gain):
+        self._gain = gain
+
+    @property
+    def start_position(self):
+        """Sample position on the mixer timeline where the layer's zero is"""
+        return self._start_position
+
+    @property
+    def exhausted(self):
+        return self._exhausted and self._next is None
+
+    def sounds_before(self, position, Fs):
+        """Yields the layer's sounds that start before a timeline position"""
+        while True:
+            if self._next is None:
+                if self._exhausted:
+                    return
+                self._next = next(self._sounds, None)
+                if self._next is None:
+                    self._exhausted = True
+                    return
+
+            start = self.start_position + self._next.start_index(Fs)
+            if start >= position:
+                return
+
+            sound, self._next = self._next, None
+            yield start, sound
+
+
+class Mixer(object):
+    """
+    Mixes any number of ordered sound generators (layers) onto one timeline.
+    The output is produced in contiguous stereo blocks, and sounds that ring
+    past the end of a block are carried over into the next one. Layers can be
+    added, removed or re-gained from another thread while the mixer plays.
+    """
+
+    def __init__(self, block_length=2, Fs=Fs, effects=None):
+        self._Fs = Fs
+        self._effects = effects
+        self._silent_samples = 0
+        self._block_samples = n_samples(block_length, Fs)
+        self._layers = {}
+        self._layer_ids = itertools.count()
+        self._position = 0
+        self._tail = np.zeros((2, 0))
+        self._lock = threading.Lock()
+
+    @property
+    def Fs(self):
+        return self._Fs
+
+    @property
+    def block_samples(self):
+        return self._block_samples
+
+    @property
+    def position(self):
+        """Sample position of the start of the next block"""
+        return self._position
+
+    @property
+    def layers(self):
+        with self._lock:
+            return dict(self._layers)
+
+    @property
+    def effects(self):
+        return self._effects
+
+    @property
+    def is_idle(self):
+        with self._lock:
+            if self._layers or self._tail.shape[1]:
+                return False
+            if self._effects is None:
+                return True
+            return self._silent_samples >= self._effects.tail_length
+
+    def add_layer(self, sounds, gain=1.0):
+        """
+        Adds an ordered sound generator whose time zero is the start of the
+        next block. Returns an id for removing or re-gaining the layer.
+        """
+        with self._lock:
+            layer_id = next(self._layer_ids)
+            self._layers[layer_id] = Layer(sounds, gain, self._position)
+            return layer_id
+
+    def remove_layer(self, layer_id):
+        """Stops pulling from a layer, sounds already mixed still ring out"""
+        with self._lock:
+            self._layers.pop(layer_id, None)
+
+    def set_gain(self, layer_id, gain):
+        with self._lock:
+            self._layers[layer_id].set_gain(gain)
+
+    def render_block(self):
+        with self._lock:
+            start = self._position
+            end = start + self.block_samples
+            layers = list(self._layers.items())
+
+            block = np.zeros((2, max(self.block_samples, self._tail.shape[1])))
+            block[:, : self._tail.shape[1]] += self._tail
+
+            for layer_id, layer in layers:
+                for position, sound in layer.sounds_before(end, self.Fs):
+                    # anything that shows up late is played straight away
+                    index = max(position - start, 0)
+                    needed = index + sound.length(self.Fs)
+                    if needed > block.shape[1]:
+                        block = np.hstack(
+                            (block, np.zeros((2, needed - block.shape[1])))
+                        )
+                    gains = tuple(
+                        gain * layer.gain for gain in sound.channel_gains
+                    )
+                    sound.add_into(block, index, gains, self.Fs)
+
+                if layer.exhausted:
+                    del self._layers[layer_id]
+
+            self._tail = block[:, self.block_samples :]
+            self._position = end
+            block = block[:, : self.block_samples]
+
+        if self._effects is not None:
+            # keep going after the last sound until the effects ring out
+            if block.any():
+                self._silent_samples = 0
+            else:
+                self._silent_samples += self.block_samples
+            block = self._effects.process(block)
+
+        return block
+
+    def blocks(self, forever=False):
+        """
+        Yields mixed blocks until every layer is exhausted and has rung out,
+        or indefinitely (silence included) if more layers may be added.
+        """
+        while forever or not self.is_idle:
+            yield self.render_block()
+
+    def play(self, forever=False, clock=None):
+        if clock is None:
+            clock = PlaybackClock(self.Fs)
+
+        audio_cleanup = None
+        for block in self.blocks(forever):
+            position = self.position - self.block_samples
+            left, right = block
+            # blocks abut, so encode before the deadline rather than after
+            filename = write_temporary_sound(left, right, self.Fs)
+
+            if audio_cleanup is not None:
+                audio_cleanup()
+
+            if clock.started:
+                clock.wait_until(position)
+            else:
+                clock.start(position)
+            audio_cleanup = play_sound_file(filename)
+            clock.mark(position)
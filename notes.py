@@ -1,31 +1,125 @@
-import math
-from collections import OrderedDict
+import functools
 
+import numpy as np
 
+
+NOTE_ORDER = (
+    "C",
+    "C#",
+    "D",
+    "D#",
+    "E",
+    "F",
+    "F#",
+    "G",
+    "G#",
+    "A",
+    "A#",
+    "B",
+)
+NOTE_INDEX = {name: index for index, name in enumerate(NOTE_ORDER)}
+
+
+# the add_* helpers work on single frequencies as well as whole arrays
 def add_half_steps(half_steps, frequency):
-    return frequency * math.pow(2, (half_steps / 12.0))
+    return frequency * np.exp2(np.divide(half_steps, 12.0))
 
 
 def add_cents(cents, frequency):
-    return frequency * math.pow(2, (cents / 1200.0))
+    return frequency * cents_ratio(cents)
 
 
 def add_whole_steps(whole_steps, frequency):
-    return frequency * math.pow(2, (whole_steps / 6.0))
+    return frequency * np.exp2(np.divide(whole_steps, 6.0))
 
 
 def add_octaves(octaves, frequency):
-    return frequency * math.pow(2, octaves)
+    return frequency * np.exp2(octaves)
+
+
+def cents_ratio(cents):
+    return np.exp2(np.divide(cents, 1200.0))
 
 
-def scientific_note_frequency(note_name):
+class Tuning(object):
     """
-    Takes a note in the form of A4 or A4# and creates a Note. The number
-    may be in the range [-1, inf), though at some point it becomes too high
-    to be interesting.
-        
-    Based on https://en.wikipedia.org/wiki/Scientific_pitch_notation
-    and https://github.com/mienaikoe/nodea/blob/gh-pages/core/Scales.js
+    A precomputed table of the frequencies of all 128 MIDI notes. The
+    reference note is tuned to the reference frequency, every other note is
+    equally tempered from it, and cent_offsets (either 12 per pitch class
+    starting at C, or 128 per note) bend individual notes.
+    """
+
+    def __init__(
+        self, reference_frequency=440.0, reference_note=69, cent_offsets=None
+    ):
+        if cent_offsets is None:
+            cent_offsets = np.zeros(12)
+        cent_offsets = np.asarray(cent_offsets, dtype=float)
+        if cent_offsets.shape not in ((12,), (128,)):
+            raise ValueError("need 12 or 128 cent offsets")
+
+        self._reference_frequency = reference_frequency
+        self._reference_note = reference_note
+        self._cent_offsets = cent_offsets
+
+        self._frequencies = self._compute(np.arange(128))
+        self._frequencies.setflags(write=False)
+
+    @property
+    def reference_frequency(self):
+        return self._reference_frequency
+
+    @property
+    def reference_note(self):
+        return self._reference_note
+
+    @property
+    def frequencies(self):
+        return self._frequencies
+
+    def _compute(self, notes):
+        if len(self._cent_offsets) == 12:
+            offsets = self._cent_offsets[notes % 12]
+        else:
+            offsets = self._cent_offsets[notes]
+        return self.reference_frequency * np.exp2(
+            (notes - self.reference_note) / 12.0 + offsets / 1200.0
+        )
+
+    def frequency(self, note):
+        if 0 <= note < 128:
+            return float(self._frequencies[note])
+        if len(self._cent_offsets) == 128:
+            raise ValueError(f"note {note} is outside of the tuning table")
+        return float(self._compute(np.array([note]))[0])
+
+    def frequencies_of(self, notes):
+        """
+        Looks up the frequencies of an array of MIDI notes all at once. Notes
+        outside of the table are handled as frequency handles them.
+        """
+        notes = np.asarray(notes, dtype=int)
+        outside = (notes < 0) | (notes >= 128)
+        if not outside.any():
+            return self._frequencies[notes]
+        if len(self._cent_offsets) == 128:
+            note = notes[outside].flat[0]
+            raise ValueError(f"note {note} is outside of the tuning table")
+
+        frequencies = self._frequencies[np.clip(notes, 0, 127)]
+        frequencies[outside] = self._compute(notes[outside])
+        return frequencies
+
+
+EQUAL_TEMPERAMENT = Tuning()
+
+
+@functools.lru_cache(maxsize=None)
+def parse_note_name(note_name):
+    """
+    Takes a note in the form of A4 or A4# and returns its MIDI note number.
+    The number may be in the range [-1, inf), though at some point it becomes
+    too high to be interesting (and falls outside of the MIDI range).
     """
 
     base_note = note_name[0]
@@ -35,37 +129,34 @@ def scientific_note_frequency(note_name):
     tail = note_name[-1]
     if tail == "#":
         sharp = True
-        note_name = note_name[:-1]
+        octave = note_name[1:-1]
     else:
         sharp = False
+        octave = note_name[1:]
 
-    octave = int(note_name[1:])
+    octave = int(octave)
     if octave < -1:
         raise ValueError("Octave cannot be less than -1")
 
-    A4 = 440.0
-    note_order = [
-        "C",
-        "C#",
-        "D",
-        "D#",
-        "E",
-        "F",
-        "F#",
-        "G",
-        "G#",
-        "A",
-        "A#",
-        "B",
-    ]
-    A_idx = note_order.index("A")
-    target_idx = note_order.index(base_note + "#" if sharp else base_note)
-
-    return add_half_steps(target_idx - A_idx, add_octaves(octave - 4, A4))
-
-
-def midi_note_frequency(note):
-    return 440.0 * pow(2, (note - 69) / 12)
+    # there is no E# or B#
+    name = base_note + "#" if sharp else base_note
+    if name not in NOTE_INDEX:
+        raise ValueError(f"unknown note: {note_name}")
+    return (octave + 1) * 12 + NOTE_INDEX[name]
+
+
+def scientific_note_frequency(note_name, tuning=EQUAL_TEMPERAMENT):
+    """
+    Takes a note in the form of A4 or A4# and returns its frequency.
+        
+    Based on https://en.wikipedia.org/wiki/Scientific_pitch_notation
+    and https://github.com/mienaikoe/nodea/blob/gh-pages/core/Scales.js
+    """
+    return tuning.frequency(parse_note_name(note_name))
+
+
+def midi_note_frequency(note, tuning=EQUAL_TEMPERAMENT):
+    return tuning.frequency(note)
 
 
 if __name__ == "__main__":
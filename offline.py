@@ -0,0 +1,158 @@
+import os
+import tempfile
+
+import numpy as np
+
+from signals import Fs, n_samples, PcmEncoder, WaveWriter
+
+
+class MemmapMix(object):
+    """
+    A stereo mix buffer backed by a memory mapped file rather than RAM, so
+    that renders far longer than memory can be accumulated. Frames are stored
+    interleaved (frames x channels) and the file grows as sounds are added
+    past its end.
+    """
+
+    CHANNELS = 2
+
+    def __init__(
+        self, filename=None, Fs=Fs, dtype=np.float32, initial_length=60
+    ):
+        if filename is None:
+            handle, filename = tempfile.mkstemp(suffix=".mix")
+            os.close(handle)
+            self._owns_file = True
+        else:
+            self._owns_file = False
+
+        self._filename = filename
+        self._Fs = Fs
+        self._dtype = np.dtype(dtype)
+        self._frames = 0
+        self._capacity = 0
+        self._buffer = None
+        self._reserve(max(n_samples(initial_length, Fs), 1))
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def Fs(self):
+        return self._Fs
+
+    @property
+    def frames(self):
+        """Frames that have had anything mixed into them"""
+        return self._frames
+
+    @property
+    def duration(self):
+        return self.frames / self.Fs
+
+    def _reserve(self, frames):
+        if frames <= self._capacity:
+            return
+
+        capacity = max(frames, 2 * self._capacity)
+        if self._buffer is not None:
+            self._buffer.flush()
+            self._buffer = None
+
+        # growing the file zero fills it (sparsely, on most file systems)
+        with open(self._filename, "r+b" if self._capacity else "wb") as f:
+            f.truncate(capacity * self.CHANNELS * self._dtype.itemsize)
+
+        self._buffer = np.memmap(
+            self._filename,
+            dtype=self._dtype,
+            mode="r+",
+            shape=(capacity, self.CHANNELS),
+        )
+        self._capacity = capacity
+
+    def add(self, start_index, waveform, gains=(1.0, 1.0)):
+        if start_index < 0:
+            raise Exception("negative times are not supported")
+
+        end_index = start_index + len(waveform)
+        self._reserve(end_index)
+        for channel, gain in enumerate(gains):
+            if gain == 1:
+                self._buffer[start_index:end_index, channel] += waveform
+            elif gain != 0:
+                self._buffer[start_index:end_index, channel] += (
+                    gain * waveform
+                )
+        self._frames = max(self._frames, end_index)
+
+    def add_sound(self, sound, offset=0):
+        start_index = sound.start_index(self.Fs) - round(offset * self.Fs)
+        if start_index < 0:
+            raise Exception("negative times are not supported")
+
+        end_index = start_index + sound.length(self.Fs)
+        self._reserve(end_index)
+        # a plain (channels x frames) view, so compiled kernels accept it
+        channels = np.asarray(self._buffer).T
+        sound.add_into(channels, start_index, sound.channel_gains, self.Fs)
+        self._frames = max(self._frames, end_index)
+
+    def blocks(self, block_length=10):
+        """Yields the mix as channels x N blocks, without loading all of it"""
+        block_frames = n_samples(block_length, self.Fs)
+        for start in range(0, self.frames, block_frames):
+            # the file has spare capacity past the last frame mixed into
+            end = min(start + block_frames, self.frames)
+            yield self._buffer[start:end].T
+
+    def write_sound(
+        self,
+        filename,
+        bits_per_sample=32,
+        floating=False,
+        block_length=10,
+        limiter=None,
+    ):
+        encoder = PcmEncoder(bits_per_sample, floating)
+        with WaveWriter(filename, encoder, self.Fs, limiter) as writer:
+            for left, right in self.blocks(block_length):
+                writer.write(left, right)
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.flush()
+            self._buffer = None
+        if self._owns_file:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def render_offline(
+    sounds,
+    filename,
+    Fs=Fs,
+    bits_per_sample=32,
+    floating=False,
+    mix=None,
+    limiter=None,
+):
+    """
+    Mixes sounds (which need not be ordered) into a memory mapped buffer and
+    then streams it out to a wave file, through the limiter if one is given.
+    Returns the rendered duration.
+    """
+    with (mix if mix is not None else MemmapMix(Fs=Fs)) as mix:
+        for sound in sounds:
+            mix.add_sound(sound)
+        mix.write_sound(filename, bits_per_sample, floating, limiter=limiter)
+        return mix.duration
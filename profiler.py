@@ -0,0 +1,198 @@
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+_DONE = object()
+
+
+def stage_name(stage):
+    """The name a stage is reported under, looking through partials"""
+    while isinstance(stage, functools.partial):
+        stage = stage.func
+    return getattr(stage, "__name__", repr(stage))
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+        self.max_depth = 0
+
+    @property
+    def items_per_second(self):
+        if self.seconds == 0:
+            return float("inf") if self.items else 0.0
+        return self.items / self.seconds
+
+    def __repr__(self):
+        return f"<StageStats {self.name}: {self.items} items in {self.seconds:.3f}s, max depth {self.max_depth}>"
+
+
+class Profiler(object):
+    """
+    Opt-in timing of sound generator stages and of the render, encode and
+    playback steps that consume them. For every stage it counts the items
+    produced, the time spent in the stage itself (not in the stages feeding
+    it) and how many items it is holding on to, its queue depth. A run can
+    be saved as a Chrome trace and opened in chrome://tracing or Perfetto.
+
+    A disabled profiler hands stages back unwrapped, so leaving one in place
+    costs nothing.
+    """
+
+    def __init__(
+        self, enabled=True, max_events=1000000, clock=time.perf_counter
+    ):
+        self._enabled = enabled
+        self._max_events = max_events
+        self._clock = clock
+        self._stats = {}
+        self._lanes = {}
+        self._events = []
+        self._origin = clock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def _stats_for(self, name):
+        if name not in self._stats:
+            self._stats[name] = StageStats(name)
+            self._lanes[name] = len(self._lanes) + 1
+        return self._stats[name]
+
+    def _timestamp(self, t):
+        return (t - self._origin) * 1e6
+
+    def _span(self, name, started, ended):
+        if len(self._events) < self._max_events:
+            self._events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": self._timestamp(started),
+                    "dur": (ended - started) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": self._lanes[name],
+                }
+            )
+
+    def _depth(self, name, t, depth):
+        if len(self._events) < self._max_events:
+            self._events.append(
+                {
+                    "name": f"{name} queue",
+                    "ph": "C",
+                    "ts": self._timestamp(t),
+                    "pid": os.getpid(),
+                    "args": {"depth": depth},
+                }
+            )
+
+    def stage(self, stage, name=None):
+        """
+        Wraps a generator stage (a function from an iterable of sounds to an
+        iterable of sounds) so that it is profiled under name.
+        """
+        if not self.enabled:
+            return stage
+        if name is None:
+            name = stage_name(stage)
+        self._stats_for(name)
+
+        def profiled(sounds):
+            return self._profile(name, stage, sounds)
+
+        return profiled
+
+    def _profile(self, name, stage, sounds):
+        clock = self._clock
+        stats = self._stats_for(name)
+        upstream_seconds = 0.0
+        consumed = 0
+
+        def upstream():
+            nonlocal upstream_seconds, consumed
+            source = iter(sounds)
+            while True:
+                started = clock()
+                sound = next(source, _DONE)
+                upstream_seconds += clock() - started
+                if sound is _DONE:
+                    return
+                consumed += 1
+                yield sound
+
+        output = iter(stage(upstream()))
+        produced = 0
+        depth = 0
+        while True:
+            waited = upstream_seconds
+            started = clock()
+            sound = next(output, _DONE)
+            ended = clock()
+            stats.seconds += (ended - started) - (upstream_seconds - waited)
+            if sound is _DONE:
+                return
+
+            produced += 1
+            stats.items += 1
+            self._span(name, started, ended)
+            if consumed - produced != depth:
+                depth = consumed - produced
+                stats.max_depth = max(stats.max_depth, depth)
+                self._depth(name, ended, depth)
+            yield sound
+
+    def step(self, name):
+        """A context manager timing one call of a step such as rendering"""
+        if not self.enabled:
+            return nullcontext()
+        return self._step(name)
+
+    @contextmanager
+    def _step(self, name):
+        stats = self._stats_for(name)
+        started = self._clock()
+        try:
+            yield
+        finally:
+            ended = self._clock()
+            stats.items += 1
+            stats.seconds += ended - started
+            self._span(name, started, ended)
+
+    def trace(self):
+        """The recorded events in the Chrome trace event format"""
+        lanes = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": lane,
+                "args": {"name": name},
+            }
+            for name, lane in self._lanes.items()
+        ]
+        return {"traceEvents": lanes + self._events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.trace(), f)
+
+    def report(self, out=sys.stdout):
+        for stats in self._stats.values():
+            print(
+                f"{stats.name:>24}: {stats.items:8d} items "
+                f"{stats.seconds:8.3f}s {stats.items_per_second:12.0f}/s "
+                f"max queue {stats.max_depth}",
+                file=out,
+            )
@@ -0,0 +1,152 @@
+import argparse
+import itertools
+import random
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import kernels
+from effects import Limiter
+from midi import build_stream_from_midi
+from infinite_gnossiennes_1 import build_graph, walk_graph
+from graph_snapshot import load_graph
+from offline import MemmapMix
+from signals import Fs
+
+
+class StageTimer(object):
+    """Accumulates wall time per named stage of a render"""
+
+    def __init__(self):
+        self._stages = {}
+
+    @property
+    def stages(self):
+        return dict(self._stages)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stages[name] = self._stages.get(name, 0) + (
+                time.perf_counter() - started
+            )
+
+    def timed(self, name, sounds):
+        """Charges the time spent producing each sound to a stage"""
+        sounds = iter(sounds)
+        while True:
+            with self.stage(name):
+                sound = next(sounds, None)
+            if sound is None:
+                return
+            yield sound
+
+
+def peak_memory_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def midi_sounds(args, timer):
+    with timer.stage("parse"):
+        stream = build_stream_from_midi(args.midi_file)
+    return stream.stream
+
+
+def graph_sounds(args, timer):
+    if args.midi_file.endswith(".graph"):
+        with timer.stage("load"):
+            graph = load_graph(args.midi_file)
+    else:
+        with timer.stage("parse"):
+            stream = build_stream_from_midi(args.midi_file)
+        with timer.stage("graph"):
+            graph = build_graph(stream.stream, timebase=args.sample_rate)
+
+    walk = walk_graph(graph, random.Random(args.seed), args.sample_rate)
+    return itertools.takewhile(lambda sound: sound.start < args.length, walk)
+
+
+def render(sounds, args, timer):
+    with MemmapMix(Fs=args.sample_rate) as mix:
+        count = 0
+        for sound in timer.timed("generate", sounds):
+            with timer.stage("synthesize"):
+                mix.add_sound(sound)
+            count += 1
+
+        limiter = None
+        if not args.no_limiter:
+            limiter = Limiter(Fs=args.sample_rate)
+        with timer.stage("encode"):
+            mix.write_sound(
+                args.output, args.bits, args.float, limiter=limiter
+            )
+
+        return mix.duration, count
+
+
+def report(duration, count, wall, timer, out=sys.stdout):
+    print(f"rendered {duration:.1f}s of audio ({count} sounds)", file=out)
+    print(f"wall time: {wall:.2f}s", file=out)
+    print(f"speed: {duration / wall:.1f}x realtime", file=out)
+    print(f"peak memory: {peak_memory_bytes() / 2 ** 20:.1f} MiB", file=out)
+    for name, seconds in timer.stages.items():
+        print(
+            f"  {name:>10}: {seconds:8.2f}s ({100 * seconds / wall:5.1f}%)",
+            file=out,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render a piece to a wave file as fast as possible."
+    )
+    parser.add_argument("-o", "--output", default="render.wav")
+    parser.add_argument("--sample-rate", type=int, default=Fs)
+    parser.add_argument("--bits", type=int, default=16)
+    parser.add_argument(
+        "--float", action="store_true", help="write 32 bit float samples"
+    )
+    parser.add_argument(
+        "--no-limiter",
+        action="store_true",
+        help="clip peaks instead of limiting them",
+    )
+    parser.add_argument("--backend", choices=("numba", "numpy"))
+    sources = parser.add_subparsers(dest="source", required=True)
+
+    midi_parser = sources.add_parser("midi", help="render a MIDI file")
+    midi_parser.add_argument("midi_file")
+    midi_parser.set_defaults(sounds=midi_sounds)
+
+    graph_parser = sources.add_parser(
+        "graph",
+        help="render a walk of a MIDI file's chord graph (or of a snapshot)",
+    )
+    graph_parser.add_argument("midi_file")
+    graph_parser.add_argument("--seed", type=int, default=0)
+    graph_parser.add_argument(
+        "--length", type=float, default=600, help="seconds of walk to render"
+    )
+    graph_parser.set_defaults(sounds=graph_sounds)
+
+    args = parser.parse_args(argv)
+    if args.float:
+        args.bits = 32
+    if args.backend is not None:
+        kernels.use_backend(args.backend)
+
+    timer = StageTimer()
+    started = time.perf_counter()
+    duration, count = render(args.sounds(args, timer), args, timer)
+    report(duration, count, time.perf_counter() - started, timer)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,59 @@ import time
 import itertools
 import tempfile
 import os
+import struct
+import threading
 
 from contextlib import contextmanager
+from collections import namedtuple
 
-import console
-import sound
 import numpy as np
 
 Fs = 44100
 
+# sample rates that rendering can be done at before being resampled up to the
+# rate of the sink; "draft" trades fidelity for a fraction of the synthesis cost
+RENDER_QUALITIES = {
+    "full": None,
+    "draft": 22050,
+    "sketch": 11025,
+}
 
-def time_array(duration):
-    return np.linspace(0, duration, n_samples(duration))
+
+def time_array(duration, Fs=Fs):
+    return np.linspace(0, duration, n_samples(duration, Fs))
     
 
-def n_samples(duration):
+def n_samples(duration, Fs=Fs):
     return int(round(duration * Fs))
 
 
+def render_rate(quality, Fs=Fs):
+    if quality not in RENDER_QUALITIES:
+        raise ValueError(f"unknown render quality: {quality}")
+
+    rate = RENDER_QUALITIES[quality]
+    if rate is None or rate > Fs:
+        return Fs
+    return rate
+
+
+def resample(data, from_Fs, to_Fs):
+    """
+    Linearly interpolates data sampled at from_Fs onto a to_Fs grid. This is
+    meant for bringing draft renders up to the sink rate, not for mastering.
+    """
+    if from_Fs == to_Fs or data.shape[-1] == 0:
+        return data
+
+    if data.ndim > 1:
+        return np.vstack([resample(row, from_Fs, to_Fs) for row in data])
+
+    target_length = int(round(len(data) * to_Fs / from_Fs))
+    positions = np.arange(target_length) * (from_Fs / to_Fs)
+    return np.interp(positions, np.arange(len(data)), data)
+
+
 def sine(freq, phase, t):
     return np.sin(2.0 * np.pi * freq * t + phase)
     
@@ -33,7 +68,7 @@ def empty():
     return np.array([])
 
 
-def add_at(base, extra, t):
+def add_at(base, extra, t, Fs=Fs):
     if t < 0:
         raise Exception("negative times are not supported")
 
@@ -47,46 +82,395 @@ def add_at(base, extra, t):
     return base
 
 
-def _join_channels(left, right):
-    target_length = max(len(left), len(right))
-    if len(left) < target_length:
-        left = np.concatenate((left, np.zeros(target_length - len(left))))
-    if len(right) < target_length:
-        right = np.concatenate((right, np.zeros(target_length - len(right))))
-    return np.vstack((left, right))
-
+class PcmEncoder(object):
+    """
+    Converts float channels in [-1, 1] into interleaved little-endian PCM
+    frames; anything outside that range is clipped, so loud mixes should go
+    through a limiter first. The scratch and frame buffers are kept between
+    calls and only grow, so encoding a run of similarly sized chunks does
+    not allocate. The returned memoryview is only valid until the next call
+    to encode.
+    """
 
-def write_sound(left, right, filename, bits_per_sample=32):
     CHANNELS = 2
 
-    data = _join_channels(left, right)
+    def __init__(self, bits_per_sample=32, floating=False):
+        if floating and bits_per_sample != 32:
+            raise ValueError("only 32 bit floating point output is supported")
+        if not floating and bits_per_sample not in (8, 16, 24, 32):
+            raise ValueError(f"unsupported bits per sample: {bits_per_sample}")
 
-    # need the data to be in a samples x channels layout
-    data = data.T
+        self._bits_per_sample = bits_per_sample
+        self._floating = floating
 
-    if bits_per_sample == 8:
-        data = data + abs(min(data))
-        data = np.array(
-            np.round((data / max(data)) * 255), dtype=np.dtype("<u1")
-        )
+        if floating:
+            self._dtype = np.dtype("<f4")
+            self._scale = 1.0
+        elif bits_per_sample == 8:
+            self._dtype = np.dtype("<u1")
+            self._scale = 127.0
+        elif bits_per_sample == 24:
+            # rendered as 32 bit integers and then packed down to 3 bytes
+            self._dtype = np.dtype("<i4")
+            self._scale = float(2 ** 23 - 1)
+        else:
+            self._dtype = np.dtype(f"<i{bits_per_sample // 8}")
+            self._scale = float(2 ** (bits_per_sample - 1) - 1)
+
+        self._scratch = np.empty((0,))
+        self._frames = np.empty((0, self.CHANNELS), dtype=self._dtype)
+        self._packed = np.empty((0, self.CHANNELS, 3), dtype=np.uint8)
+
+    @property
+    def bits_per_sample(self):
+        return self._bits_per_sample
+
+    @property
+    def sample_width(self):
+        return self._bits_per_sample // 8
+
+    @property
+    def floating(self):
+        return self._floating
+
+    def _reserve(self, length):
+        if len(self._scratch) < length:
+            self._scratch = np.empty((length,))
+            self._frames = np.empty((length, self.CHANNELS), dtype=self._dtype)
+            if self.bits_per_sample == 24:
+                self._packed = np.empty(
+                    (length, self.CHANNELS, 3), dtype=np.uint8
+                )
+
+    def _scaled(self, channel):
+        scratch = self._scratch[: len(channel)]
+        if self.bits_per_sample == 8:
+            # 8 bit wave data is unsigned, centered on 128
+            np.multiply(channel, self._scale, out=scratch)
+            np.clip(scratch, -self._scale, self._scale, out=scratch)
+            np.rint(scratch, out=scratch)
+            np.add(scratch, 128, out=scratch)
+        elif self.floating:
+            np.clip(channel, -1.0, 1.0, out=scratch)
+        else:
+            np.multiply(channel, self._scale, out=scratch)
+            np.clip(scratch, -self._scale, self._scale, out=scratch)
+            np.rint(scratch, out=scratch)
+        return scratch
+
+    def encode(self, left, right=None):
+        """
+        Encodes a pair of channels. Passing the same array (or None) as right
+        takes the mono fast path, which converts the samples only once.
+        """
+        mono = right is None or right is left
+        if mono:
+            right = left
+
+        length = max(len(left), len(right))
+        self._reserve(length)
+        frames = self._frames[:length]
+
+        silence = 128 if self.bits_per_sample == 8 else 0
+        for index, channel in enumerate((left, right)):
+            if mono and index == 1:
+                frames[:, 1] = frames[:, 0]
+                break
+            frames[: len(channel), index] = self._scaled(channel)
+            frames[len(channel) :, index] = silence
+
+        if self.bits_per_sample == 24:
+            packed = self._packed[:length]
+            packed[...] = frames.view(np.uint8).reshape(
+                (length, self.CHANNELS, 4)
+            )[:, :, :3]
+            return memoryview(packed).cast("B")
+
+        return memoryview(frames).cast("B")
+
+
+# encoders reuse their buffers, so each thread (players render and encode on
+# executor threads) gets encoders of its own
+_encoders = threading.local()
+
+
+def _shared_encoder(bits_per_sample, floating):
+    encoders = getattr(_encoders, "encoders", None)
+    if encoders is None:
+        encoders = _encoders.encoders = {}
+    key = (bits_per_sample, floating)
+    if key not in encoders:
+        encoders[key] = PcmEncoder(bits_per_sample, floating)
+    return encoders[key]
+
+
+def _float_wave_header(data_length, channels, Fs):
+    # the wave module only writes integer PCM, so float data gets a minimal
+    # WAVE_FORMAT_IEEE_FLOAT header written by hand
+    sample_width = 4
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_length,
+        b"WAVE",
+        b"fmt ",
+        16,
+        3,
+        channels,
+        Fs,
+        Fs * channels * sample_width,
+        channels * sample_width,
+        sample_width * 8,
+        b"data",
+        data_length,
+    )
+
+
+class WaveWriter(object):
+    """
+    Writes a wave file a block at a time, so long renders never need to be
+    encoded in one piece. Use it as a context manager.
+
+    If a limiter (such as effects.Limiter) is given, the blocks are passed
+    through it before encoding. Its latency is taken out again, and what is
+    left in it is written when the file is closed.
+    """
+
+    def __init__(self, filename, encoder, Fs=Fs, limiter=None):
+        self._filename = filename
+        self._encoder = encoder
+        self._Fs = Fs
+        self._limiter = limiter
+        self._skip = 0 if limiter is None else limiter.latency
+        self._channels = 1
+        self._file = None
+        self._data_length = 0
+
+    def __enter__(self):
+        if self._encoder.floating:
+            self._file = open(self._filename, "wb")
+            self._file.write(
+                _float_wave_header(0, PcmEncoder.CHANNELS, self._Fs)
+            )
+        else:
+            self._file = wave.open(self._filename, mode="wb")
+            self._file.setparams(
+                (
+                    PcmEncoder.CHANNELS,
+                    self._encoder.sample_width,
+                    self._Fs,
+                    0,
+                    "NONE",
+                    "not compressed",
+                )
+            )
+        return self
+
+    def write(self, left, right=None):
+        if self._limiter is not None:
+            if right is None or right is left:
+                samples = np.atleast_2d(left)
+            else:
+                samples = np.zeros((2, max(len(left), len(right))))
+                samples[0, : len(left)] = left
+                samples[1, : len(right)] = right
+            self._channels = len(samples)
+            limited = self._limit(samples)
+            left = limited[0]
+            right = left if self._channels == 1 else limited[1]
+            if not len(left):
+                return
+        self.write_frames(self._encoder.encode(left, right))
+
+    def _limit(self, samples):
+        limited = self._limiter.process(samples)
+        skipped = min(self._skip, limited.shape[1])
+        self._skip -= skipped
+        return limited[:, skipped:]
+
+    def write_frames(self, data):
+        """Writes frames that are already encoded in the file's format"""
+        if self._encoder.floating:
+            self._file.write(data)
+            self._data_length += len(data)
+        else:
+            self._file.writeframes(data)
+
+    def __exit__(self, *exc_info):
+        if self._limiter is not None and exc_info[0] is None:
+            left, right = np.zeros((2, self._limiter.latency))
+            self.write(left, left if self._channels == 1 else right)
+        if self._encoder.floating:
+            self._file.seek(0)
+            self._file.write(
+                _float_wave_header(
+                    self._data_length, PcmEncoder.CHANNELS, self._Fs
+                )
+            )
+        self._file.close()
+
+
+def write_sound(
+    left,
+    right,
+    filename,
+    bits_per_sample=32,
+    Fs=Fs,
+    floating=False,
+    encoder=None,
+    limiter=None,
+):
+    if encoder is None:
+        encoder = _shared_encoder(bits_per_sample, floating)
+
+    with WaveWriter(filename, encoder, Fs, limiter) as writer:
+        writer.write(left, right)
+
+
+class PcmCache(object):
+    """
+    Keeps the encoded PCM of a mix around so that after an edit only the
+    sample ranges that changed have to be encoded again.
+    """
+
+    def __init__(self, bits_per_sample=32, floating=False):
+        self._encoder = PcmEncoder(bits_per_sample, floating)
+        self._frame_bytes = PcmEncoder.CHANNELS * self._encoder.sample_width
+        self._data = bytearray()
+
+    @property
+    def encoder(self):
+        return self._encoder
+
+    @property
+    def frames(self):
+        return len(self._data) // self._frame_bytes
+
+    @property
+    def data(self):
+        return memoryview(self._data)
+
+    def update(self, left, right, ranges):
+        """
+        Re-encodes the given (start, end) frame ranges of the channels; a
+        change in length re-encodes the new frames too.
+        """
+        length = max(len(left), len(right))
+        ranges = list(ranges)
+        if length > self.frames:
+            ranges.append((self.frames, length))
+            grown = length - self.frames
+            self._data.extend(bytes(grown * self._frame_bytes))
+        elif length < self.frames:
+            del self._data[length * self._frame_bytes :]
+
+        mono = right is left
+        for start, end in ranges:
+            encoded = self._encoder.encode(
+                left[start:end], None if mono else right[start:end]
+            )
+            self._data[
+                start * self._frame_bytes : start * self._frame_bytes
+                + len(encoded)
+            ] = encoded
+
+    def write_sound(self, filename, Fs=Fs):
+        with WaveWriter(filename, self._encoder, Fs) as writer:
+            writer.write_frames(self._data)
+
+
+WaveLayout = namedtuple(
+    "WaveLayout", "channels, sample_width, floating, Fs, data_offset, frames"
+)
+
+
+def wave_layout(filename):
+    """
+    Walks the RIFF chunks of a wave file to find where its sample data is, so
+    the data can be read (or memory mapped) directly.
+    """
+    with open(filename, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(f"not a wave file: {filename}")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"no data chunk in {filename}")
+            chunk_id, size = struct.unpack("<4sI", header)
+
+            if chunk_id == b"fmt ":
+                fmt_data = f.read(size + (size % 2))
+                fmt = list(struct.unpack("<HHIIHH", fmt_data[:16]))
+                if fmt[0] == 0xFFFE and size >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE, the subformat GUID starts
+                    # with the actual format tag
+                    fmt[0] = struct.unpack("<H", fmt_data[24:26])[0]
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError(f"data before fmt in {filename}")
+                format_tag, channels, rate, _, block_align, bits = fmt
+                if format_tag not in (1, 3):
+                    raise ValueError(f"unsupported wave format: {format_tag}")
+                return WaveLayout(
+                    channels=channels,
+                    sample_width=bits // 8,
+                    floating=format_tag == 3,
+                    Fs=rate,
+                    data_offset=f.tell(),
+                    frames=size // block_align,
+                )
+            else:
+                f.seek(size + (size % 2), os.SEEK_CUR)
+
+
+def decode_frames(raw, layout):
+    """Turns raw little-endian frames into a channels x frames float array"""
+    raw = np.frombuffer(raw, dtype=np.uint8)
+    frames = len(raw) // (layout.channels * layout.sample_width)
+    raw = raw[: frames * layout.channels * layout.sample_width]
+
+    if layout.floating:
+        data = raw.view(f"<f{layout.sample_width}").astype(float)
+    elif layout.sample_width == 1:
+        data = (raw.astype(float) - 128) / 127
+    elif layout.sample_width == 3:
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = raw.reshape((-1, 3))
+        data = padded.view("<i4")[:, 0] / float(2 ** 31 - 2 ** 8)
     else:
-        data = np.array(
-            np.round(data * ((2 ** (bits_per_sample - 1)) - 1)),
-            dtype=np.dtype(f"<i{bits_per_sample//8}"),
+        bits = layout.sample_width * 8
+        data = raw.view(f"<i{layout.sample_width}") / float(
+            2 ** (bits - 1) - 1
         )
 
-    with wave.open(filename, mode="wb") as f:
-        f.setparams(
-            (CHANNELS, bits_per_sample // 8, Fs, 0, "NONE", "not compressed")
-        )
-        f.writeframes(data.tostring())
+    return data.reshape((frames, layout.channels)).T
+
 
+def read_sound(filename):
+    """Reads a whole wave file into a channels x frames float array"""
+    layout = wave_layout(filename)
+    with open(filename, "rb") as f:
+        f.seek(layout.data_offset)
+        raw = f.read(layout.frames * layout.channels * layout.sample_width)
+    return decode_frames(raw, layout), layout.Fs
 
-def play_sound_asynchronously(left, right):
+
+def write_temporary_sound(left, right, Fs=Fs):
     with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
         filename = f.name
 
-    write_sound(left, right, filename)
+    write_sound(left, right, filename, Fs=Fs)
+    return filename
+
+
+def play_sound_file(filename):
+    # Pythonista's modules are only needed to actually play something, which
+    # keeps offline rendering usable off the device
+    import sound
+
     sound.play_effect(filename)
 
     def cleanup():
@@ -97,9 +481,14 @@ def play_sound_asynchronously(left, right):
 
     return cleanup
 
+
+def play_sound_asynchronously(left, right, Fs=Fs):
+    return play_sound_file(write_temporary_sound(left, right, Fs))
+
 @contextmanager
 def prevent_device_sleep():
     def fix_set_idle_timer_disabled(flag=True):
+        import console
         from objc_util import on_main_thread
 
         on_main_thread(console.set_idle_timer_disabled)(flag)
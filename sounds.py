@@ -6,39 +6,103 @@ import os
 import functools
 from abc import ABC, abstractmethod
 import math
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import numpy as np
 
+import kernels
 from signals import (
+    Fs,
     sine,
-    time_array,
     add_at,
     n_samples,
+    resample,
+    wave_layout,
+    decode_frames,
     play_sound_asynchronously,
 )
 
 
 class Sound(ABC):
-    def __init__(self, start, duration):
+    """
+    Start and duration are seconds, unless a timebase (a sample rate) is
+    given, in which case they are integer sample counts at that rate. The
+    start and duration properties are always in seconds; start_index and
+    length give exact sample positions for rendering.
+    """
+
+    def __init__(self, start, duration, pan=0, timebase=None):
+        if not -1 <= pan <= 1:
+            raise ValueError("pan must be between -1 and 1")
         self._start = start
         self._duration = duration
+        self._pan = pan
+        self._timebase = timebase
 
     @abstractmethod
     def copy(self):
         pass
 
+    @property
+    def render_key(self):
+        """
+        A tuple of everything the sound renders from. Sounds of the same type
+        with equal keys render identically.
+        """
+        return (self._start, self._duration, self._timebase, self._pan)
+
+    @property
+    def timebase(self):
+        """The sample rate start and duration are counted in, or None"""
+        return self._timebase
+
     @property
     def start(self):
-        return self._start
+        if self._timebase is None:
+            return self._start
+        return self._start / self._timebase
 
     @property
     def duration(self):
-        return self._duration
+        if self._timebase is None:
+            return self._duration
+        return self._duration / self._timebase
 
     @property
     def end(self):
-        return self.start + self.duration
+        if self._timebase is None:
+            return self.start + self.duration
+        return (self._start + self._duration) / self._timebase
+
+    def start_index(self, Fs=Fs):
+        """The sample the sound starts on when rendered at Fs"""
+        if self._timebase == Fs:
+            return self._start
+        if self._timebase is None:
+            return round(self._start * Fs)
+        return round(self._start * Fs / self._timebase)
+
+    def length(self, Fs=Fs):
+        """The number of samples the sound renders to at Fs"""
+        if self._timebase == Fs:
+            return self._duration
+        return n_samples(self.duration, Fs)
+
+    @property
+    def pan(self):
+        """Stereo position from -1 (hard left) through 0 to 1 (hard right)"""
+        return self._pan
+
+    @property
+    def volume(self):
+        """Peak level; sounds without one of their own play at full level"""
+        return 1.0
+
+    @property
+    def channel_gains(self):
+        # a balance law rather than constant power, so that centered sounds
+        # come out at full level on both channels just like the mono mix
+        return min(1.0, 1.0 - self.pan), min(1.0, 1.0 + self.pan)
 
     @property
     @abstractmethod
@@ -47,16 +111,75 @@ class Sound(ABC):
 
     @property
     def waveform(self):
-        return self.waveform_source(time_array(self.duration))
+        return self.rendered()
+
+    def rendered(self, Fs=Fs):
+        t = np.linspace(0, self.duration, self.length(Fs))
+        return self.waveform_source(t, Fs)
+
+    def add_into(self, out, start_index, gains, Fs=Fs):
+        """
+        Mixes the sound into the channels of out (a channels x N array),
+        starting at start_index, with a gain per channel.
+        """
+        waveform = self.rendered(Fs)
+        end_index = start_index + len(waveform)
+        for channel, gain in zip(out, gains):
+            if gain == 1:
+                channel[start_index:end_index] += waveform
+            elif gain != 0:
+                channel[start_index:end_index] += gain * waveform
+
+    # the -ed methods return modified copies, the bare verbs modify the sound
+    # in place and are meant for sounds that nothing else refers to yet
+
+    def delay(self, offset):
+        if self._timebase is None:
+            self._start += offset
+        else:
+            self._start += round(offset * self._timebase)
+
+    def delay_samples(self, samples, Fs=Fs):
+        """Delays by a whole number of samples at Fs, exactly if possible"""
+        if self._timebase == Fs:
+            self._start += samples
+        else:
+            self.delay(samples / Fs)
+
+    def stretch(self, scale):
+        if self._timebase is None:
+            self._duration *= scale
+        else:
+            self._duration = round(self._duration * scale)
+
+    def pan_to(self, pan):
+        if not -1 <= pan <= 1:
+            raise ValueError("pan must be between -1 and 1")
+        self._pan = pan
+
+    def quantize(self, Fs=Fs):
+        """Switches the sound to integer sample positions at Fs"""
+        start, length = self.start_index(Fs), self.length(Fs)
+        self._start, self._duration, self._timebase = start, length, Fs
 
     def delayed(self, offset):
         c = self.copy()
-        c._start += offset
+        c.delay(offset)
         return c
 
     def stretched(self, scale):
         c = self.copy()
-        c._duration *= scale
+        c.stretch(scale)
+        return c
+
+    def panned(self, pan):
+        c = self.copy()
+        c.pan_to(pan)
+        return c
+
+    def quantized(self, Fs=Fs):
+        c = self.copy()
+        c.quantize(Fs)
         return c
 
 
@@ -77,8 +200,10 @@ class Tone(Sound):
         decay_seconds,
         sustain_level,
         release_seconds,
+        pan=0,
+        timebase=None,
     ):
-        super().__init__(start, duration)
+        super().__init__(start, duration, pan, timebase)
         self._frequency = frequency
         self._overtones = overtones
         self._volume = volume
@@ -88,16 +213,19 @@ class Tone(Sound):
         self._release_seconds = release_seconds
 
     def copy(self):
+        # overtones are never modified in place, so copies can share them
         return Tone(
-            self.start,
-            self.duration,
+            self._start,
+            self._duration,
             self.frequency,
-            self.overtones,
+            self._overtones,
             self.volume,
             self.attack_seconds,
             self.decay_seconds,
             self.sustain_level,
             self.release_seconds,
+            self.pan,
+            self.timebase,
         )
 
     @property
@@ -108,6 +236,18 @@ class Tone(Sound):
     def overtones(self):
         return self._overtones.copy()
 
+    @property
+    def render_key(self):
+        return super().render_key + (
+            self._frequency,
+            tuple(self._overtones),
+            self._volume,
+            self._attack_seconds,
+            self._decay_seconds,
+            self._sustain_level,
+            self._release_seconds,
+        )
+
     @property
     def volume(self):
         return self._volume
@@ -130,7 +270,7 @@ class Tone(Sound):
 
     @property
     def waveform_source(self):
-        def ws(t):
+        def ws(t, Fs=Fs):
             result = sine(self.frequency, 0, t)
             for frequency_multiplier, phase_shift, amplitude in self.overtones:
                 result += amplitude * sine(
@@ -139,18 +279,7 @@ class Tone(Sound):
 
             total_samples = len(t)
             ATTACK, DECAY, RELEASE = 0, 1, 2
-            phase_samples = [
-                n_samples(t)
-                for t in (
-                    self.attack_seconds,
-                    self.decay_seconds,
-                    self.release_seconds,
-                )
-            ]
-            i = 0
-            while sum(phase_samples) > total_samples:
-                phase_samples[i] = math.floor(phase_samples[i] * 0.9)
-                i = (i + 1) % 3
+            phase_samples = self._phase_samples(total_samples, Fs)
             sustain_samples = total_samples - sum(phase_samples)
             result *= np.concatenate(
                 (
@@ -175,13 +304,263 @@ class Tone(Sound):
 
         return ws
         
+    def _phase_samples(self, total_samples, Fs):
+        """The attack, decay and release lengths, shrunk to fit the tone"""
+        phase_samples = [
+            n_samples(t, Fs)
+            for t in (
+                self.attack_seconds,
+                self.decay_seconds,
+                self.release_seconds,
+            )
+        ]
+        i = 0
+        while sum(phase_samples) > total_samples:
+            phase_samples[i] = math.floor(phase_samples[i] * 0.9)
+            i = (i + 1) % 3
+        return phase_samples
+
+    def add_into(self, out, start_index, gains, Fs=Fs):
+        if kernels.BACKEND != "numba":
+            return super().add_into(out, start_index, gains, Fs)
+
+        total_samples = self.length(Fs)
+        kernels.add_tone_into(
+            out,
+            start_index,
+            self,
+            gains,
+            total_samples,
+            self._phase_samples(total_samples, Fs),
+        )
+
+    def detune(self, mutator):
+        self._frequency = mutator(self._frequency)
+
     def detuned(self, mutator):
         c = self.copy()
-        c._frequency = mutator(c.frequency)
+        c.detune(mutator)
         return c
         
     def __repr__(self):
-        return f"<Tone {self.duration}s at {self.start}s, {self.frequency}Hz with {self.overtones} overtones, {self.volume} volume, ADSR({self.attack_seconds}, {self.decay_seconds}, {self.sustain_level}, {self.release_seconds})>"
+        return f"<Tone {self.duration}s at {self.start}s, {self.frequency}Hz with {self.overtones} overtones, {self.volume} volume, ADSR({self.attack_seconds}, {self.decay_seconds}, {self.sustain_level}, {self.release_seconds}), {self.pan} pan>"
+
+
+class Recording(Sound):
+    """
+    A sound that plays back an already rendered buffer. Copies (and so
+    delayed or panned versions) share the buffer rather than duplicating it.
+    """
+
+    def __init__(self, start, samples, Fs=Fs, pan=0, timebase=None):
+        if timebase is None:
+            duration = len(samples) / Fs
+        else:
+            duration = round(len(samples) * timebase / Fs)
+        super().__init__(start, duration, pan, timebase)
+        self._samples = samples
+        self._Fs = Fs
+        self._resampled = {Fs: samples}
+
+    def copy(self):
+        c = Recording(
+            self._start, self._samples, self._Fs, self.pan, self.timebase
+        )
+        c._duration = self._duration
+        c._resampled = self._resampled
+        return c
+
+    @property
+    def Fs(self):
+        return self._Fs
+
+    @property
+    def render_key(self):
+        # copies share their buffer, so the buffer's identity stands for it
+        return super().render_key + (id(self._samples), self._Fs)
+
+    @property
+    def waveform_source(self):
+        def ws(t, Fs=Fs):
+            if Fs not in self._resampled:
+                self._resampled[Fs] = resample(self._samples, self._Fs, Fs)
+            samples = self._resampled[Fs]
+
+            if len(samples) >= len(t):
+                return samples[: len(t)].copy()
+            return np.concatenate((samples, np.zeros(len(t) - len(samples))))
+
+        return ws
+
+    def __repr__(self):
+        return f"<Recording {self.duration}s at {self.start}s, {self.pan} pan>"
+
+
+class SampleBank(object):
+    """
+    A set of recorded samples, each a wave file that is memory mapped rather
+    than loaded, along with the pitch it was recorded at. Repitched copies of
+    the samples are cached (up to cache_size of them) since instruments tend
+    to play the same few notes over and over. The decoded mono mix of each
+    sample is kept in the same cache, so it is only decoded again once it
+    has gone unused for a while.
+    """
+
+    def __init__(self, cache_size=64):
+        self._samples = {}
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def add(self, name, filename, root_frequency):
+        layout = wave_layout(filename)
+        raw = np.memmap(
+            filename,
+            dtype=np.uint8,
+            mode="r",
+            offset=layout.data_offset,
+            shape=(layout.frames * layout.channels * layout.sample_width,),
+        )
+        self._samples[name] = (raw, layout, root_frequency)
+        # replacing a sample drops whatever was decoded from the old one
+        for key in [key for key in self._cache if key[0] == name]:
+            del self._cache[key]
+
+    @property
+    def names(self):
+        return set(self._samples)
+
+    def root_frequency(self, name):
+        return self._samples[name][2]
+
+    def _cached(self, key, build):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        data = build()
+        data.setflags(write=False)
+        self._cache[key] = data
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def _mono_samples(self, name):
+        raw, layout, _ = self._samples[name]
+        return self._cached(
+            (name, None),
+            lambda: np.mean(decode_frames(raw, layout), axis=0),
+        )
+
+    def repitched(self, name, frequency, Fs=Fs):
+        """
+        The whole sample, mixed down to mono and resampled so that it sounds
+        at frequency when played back at Fs.
+        """
+        _, layout, root_frequency = self._samples[name]
+        step = (frequency / root_frequency) * (layout.Fs / Fs)
+
+        def build():
+            data = self._mono_samples(name)
+            if step == 1:
+                return data
+            positions = np.arange(0, len(data) - 1, step)
+            return np.interp(positions, np.arange(len(data)), data)
+
+        return self._cached((name, round(step, 9)), build)
+
+
+class Sampler(Sound):
+    """
+    Plays a sample from a SampleBank, repitched to frequency. The sound is
+    cut off (with a short fade out) after duration, or runs out as silence
+    if the sample is shorter than that.
+    """
+
+    def __init__(
+        self,
+        start,
+        duration,
+        bank,
+        name,
+        frequency,
+        volume,
+        release_seconds=0.05,
+        pan=0,
+        timebase=None,
+    ):
+        super().__init__(start, duration, pan, timebase)
+        self._bank = bank
+        self._name = name
+        self._frequency = frequency
+        self._volume = volume
+        self._release_seconds = release_seconds
+
+    def copy(self):
+        return Sampler(
+            self._start,
+            self._duration,
+            self._bank,
+            self.name,
+            self.frequency,
+            self.volume,
+            self.release_seconds,
+            self.pan,
+            self.timebase,
+        )
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @property
+    def release_seconds(self):
+        return self._release_seconds
+
+    @property
+    def render_key(self):
+        return super().render_key + (
+            id(self._bank),
+            self._name,
+            self._frequency,
+            self._volume,
+            self._release_seconds,
+        )
+
+    @property
+    def waveform_source(self):
+        def ws(t, Fs=Fs):
+            samples = self._bank.repitched(self.name, self.frequency, Fs)
+            total_samples = len(t)
+
+            result = np.zeros(total_samples)
+            played = min(total_samples, len(samples))
+            np.multiply(samples[:played], self.volume, out=result[:played])
+
+            release = min(n_samples(self.release_seconds, Fs), total_samples)
+            if release:
+                result[total_samples - release :] *= np.linspace(1, 0, release)
+            return result
+
+        return ws
+
+    def detune(self, mutator):
+        self._frequency = mutator(self._frequency)
+
+    def detuned(self, mutator):
+        c = self.copy()
+        c.detune(mutator)
+        return c
+
+    def __repr__(self):
+        return f"<Sampler {self.name} {self.duration}s at {self.start}s, {self.frequency}Hz, {self.volume} volume, {self.pan} pan>"
 
 
 if __name__ == "__main__":
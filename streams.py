@@ -1,17 +1,259 @@
+import collections
+import functools
+import heapq
 import itertools
 import time
 
-from signals import empty, add_at, play_sound_asynchronously
-from sounds import Tone
+import numpy as np
+
+from signals import (
+    Fs,
+    resample,
+    render_rate,
+    write_temporary_sound,
+    play_sound_file,
+)
+from sounds import Tone, Recording
+from profiler import Profiler
+
+
+class PlaybackClock(object):
+    """
+    A single master clock for chunked playback. Chunks are scheduled by
+    their sample position on the timeline, so every deadline is computed
+    from the same anchor and timing errors cannot accumulate.
+    """
+
+    def __init__(self, Fs=Fs, clock=time.monotonic, sleep=time.sleep):
+        self._Fs = Fs
+        self._clock = clock
+        self._sleep = sleep
+        self._anchor = None
+        self._drift = 0
+        self._max_drift = 0
+        self._late_chunks = 0
+
+    @property
+    def Fs(self):
+        return self._Fs
+
+    @property
+    def started(self):
+        return self._anchor is not None
+
+    @property
+    def drift(self):
+        """
+        Seconds that the most recent chunk started after its deadline. Since
+        deadlines are absolute this is also the cumulative drift.
+        """
+        return self._drift
+
+    @property
+    def max_drift(self):
+        return self._max_drift
+
+    @property
+    def late_chunks(self):
+        return self._late_chunks
+
+    def start(self, position=0):
+        self._anchor = self._clock() - position / self.Fs
+
+    def deadline(self, position):
+        return self._anchor + position / self.Fs
+
+    def time_until(self, position):
+        return self.deadline(position) - self._clock()
+
+    def wait_until(self, position):
+        time_left = self.time_until(position)
+        if time_left > 0:
+            self._sleep(time_left)
+        return time_left
+
+    def mark(self, position):
+        """Records when the chunk at position actually started"""
+        self._drift = self._clock() - self.deadline(position)
+        self._max_drift = max(self._max_drift, self._drift)
+        if self._drift > 0:
+            self._late_chunks += 1
+
+
+class ChunkLengthController(object):
+    """
+    Picks the length_break of each chunk during live playback. A chunk is
+    rendered while the previous one plays, so rendering must fit in about a
+    chunk's length. Render time is modelled as a fixed overhead plus a cost
+    per second of audio, fitted to the recent chunks, and the next chunk is
+    made as short as it can be while leaving safety_margin (a fraction of the
+    chunk's length) spare before the deadline. Short chunks start sooner and
+    use less memory, long ones amortize the overhead.
+
+    The length changes by at most a factor of max_growth per chunk and is
+    kept between minimum and maximum.
+    """
+
+    def __init__(
+        self,
+        length_break=4,
+        minimum=0.5,
+        maximum=30,
+        safety_margin=0.5,
+        max_growth=2,
+        history=16,
+    ):
+        if not 0 < minimum <= length_break <= maximum:
+            raise ValueError(
+                "length_break must be between minimum and maximum"
+            )
+        if not 0 <= safety_margin < 1:
+            raise ValueError("safety_margin must be between 0 and 1")
+
+        self._length_break = length_break
+        self._minimum = minimum
+        self._maximum = maximum
+        self._safety_margin = safety_margin
+        self._max_growth = max_growth
+        self._observations = collections.deque(maxlen=history)
+        self._overhead = 0.0
+        self._cost_per_second = 0.0
+        self._chosen_lengths = [length_break]
+
+    @property
+    def length_break(self):
+        """The target length of the next chunk"""
+        return self._length_break
+
+    @property
+    def minimum(self):
+        return self._minimum
+
+    @property
+    def maximum(self):
+        return self._maximum
+
+    @property
+    def safety_margin(self):
+        return self._safety_margin
+
+    @property
+    def overhead(self):
+        """Estimated render seconds per chunk regardless of its length"""
+        return self._overhead
+
+    @property
+    def cost_per_second(self):
+        """Estimated render seconds per second of audio"""
+        return self._cost_per_second
+
+    @property
+    def observations(self):
+        """The recent (audio seconds, render seconds) of each chunk"""
+        return list(self._observations)
+
+    @property
+    def chosen_lengths(self):
+        """Every length_break handed out so far, in order"""
+        return list(self._chosen_lengths)
+
+    def _fit(self):
+        audio, render = np.array(self._observations).T
+        if len(audio) > 1 and np.ptp(audio) > 0:
+            # a least squares line through the observations; chunks of
+            # nearly the same length leave it badly conditioned, and then
+            # only the total cost per second is trusted
+            design = np.column_stack((audio, np.ones_like(audio)))
+            (cost, overhead), _, rank, _ = np.linalg.lstsq(
+                design, render, rcond=None
+            )
+            if rank == 2 and overhead >= 0 and cost >= 0:
+                return float(overhead), float(cost)
+        return 0.0, float(np.sum(render) / max(np.sum(audio), 1e-9))
+
+    def observe(self, audio_seconds, render_seconds):
+        """Records a rendered chunk and picks the next chunk's length"""
+        self._observations.append((audio_seconds, render_seconds))
+        self._overhead, self._cost_per_second = self._fit()
+
+        budget = 1 - self.safety_margin
+        if self.cost_per_second < budget:
+            wanted = self.overhead / (budget - self.cost_per_second)
+        else:
+            # rendering is slower than the margin allows at any length, so
+            # the best we can do is spread the overhead as thin as possible
+            wanted = self.maximum
+
+        length = self._length_break
+        length = min(
+            max(wanted, length / self._max_growth), length * self._max_growth
+        )
+        self._length_break = min(max(length, self.minimum), self.maximum)
+        self._chosen_lengths.append(self._length_break)
+        return self._length_break
+
+
+def chunk_target_length(length_break):
+    """The chunk length to aim for, from a length or a controller"""
+    if isinstance(length_break, ChunkLengthController):
+        return length_break.length_break
+    return length_break
+
+
+def start_index_of(sound):
+    """
+    A sort key for sounds. Ordering and grouping by sample position is exact
+    for sounds with a timebase, and puts sounds with and without one on the
+    same grid.
+    """
+    return sound.start_index()
+
+
+def _merge_ranges(ranges, length):
+    merged = []
+    for start, end in sorted(ranges):
+        start, end = max(start, 0), min(end, length)
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 class Stream(object):
     def __init__(self):
         self._sounds = set()
+        # only kept up to date once render_incremental has been called
+        self._rendered = None
+        self._added = []
+        self._removed = []
 
     def add_sound(self, sound):
+        if sound in self._sounds:
+            return
         self._sounds.add(sound)
 
+        if self._rendered is not None:
+            if sound in self._removed:
+                self._removed.remove(sound)
+            else:
+                self._added.append(sound)
+
+    def remove_sound(self, sound):
+        self._sounds.remove(sound)
+
+        if self._rendered is not None:
+            if sound in self._added:
+                self._added.remove(sound)
+            else:
+                self._removed.append(sound)
+
+    def replace_sound(self, old, new):
+        self.remove_sound(old)
+        self.add_sound(new)
+
     @property
     def sounds(self):
         return self._sounds
@@ -38,33 +280,133 @@ class Stream(object):
 
     @property
     def stream(self):
-        for sound in sorted(self.sounds, key=lambda sound: sound.start):
+        for sound in sorted(self.sounds, key=start_index_of):
             yield sound
 
-    def waveform(self, offset=0):
-        chunk_waveform = empty()
+    def _placements(self, offset, Fs):
+        """Start indices of the sounds, and the length needed to hold them"""
+        offset_index = round(offset * Fs)
+        placements = []
+        length = 0
         for sound in self.sounds:
-            chunk_waveform = add_at(
-                chunk_waveform, sound.waveform, sound.start - offset
-            )
+            start_index = sound.start_index(Fs) - offset_index
+            if start_index < 0:
+                raise Exception("negative times are not supported")
+            placements.append((sound, start_index))
+            length = max(length, start_index + sound.length(Fs))
+        return placements, length
+
+    def waveform(self, offset=0, Fs=Fs):
+        placements, length = self._placements(offset, Fs)
+        chunk_waveform = np.zeros((1, length))
+        for sound, start_index in placements:
+            sound.add_into(chunk_waveform, start_index, (1.0,), Fs)
+        return chunk_waveform[0]
+
+    @property
+    def is_centered(self):
+        return all(sound.pan == 0 for sound in self.sounds)
+
+    def stereo_waveform(self, offset=0, Fs=Fs):
+        """
+        Mixes the sounds into a 2xN buffer. Every sound is synthesized once
+        and added to each channel with the gains from its pan.
+        """
+        placements, length = self._placements(offset, Fs)
+        chunk_waveform = np.zeros((2, length))
+        for sound, start_index in placements:
+            gains = sound.channel_gains
+            sound.add_into(chunk_waveform, start_index, gains, Fs)
         return chunk_waveform
 
+    def recorded(self, Fs=Fs):
+        """
+        Renders the stream once into Recordings starting at min_start: a
+        single centered one, or a hard left and hard right pair if anything
+        in the stream is panned.
+        """
+        start = self.min_start
+        if self.is_centered:
+            return [Recording(start, self.waveform(start, Fs), Fs)]
+
+        left, right = self.stereo_waveform(start, Fs)
+        return [
+            Recording(start, left, Fs, pan=-1),
+            Recording(start, right, Fs, pan=1),
+        ]
+
+    def render_incremental(self, offset=0, Fs=Fs):
+        """
+        Returns the stereo mix of the stream along with the sample ranges
+        that changed since the previous call. Only sounds added or removed
+        since then are synthesized, and they are added to or subtracted from
+        the previous mix. Sounds must not be modified in place while they are
+        part of the stream; replace them instead.
+        """
+        if self._rendered is None or self._rendered[:2] != (offset, Fs):
+            buffer = self.stereo_waveform(offset, Fs)
+            self._rendered = (offset, Fs, buffer)
+            self._added, self._removed = [], []
+            length = buffer.shape[1]
+            return buffer, _merge_ranges([(0, length)], length)
+
+        buffer = self._rendered[2]
+        offset_index = round(offset * Fs)
+        ranges = []
+        for sign, sounds in ((-1, self._removed), (1, self._added)):
+            for sound in sounds:
+                start_index = sound.start_index(Fs) - offset_index
+                if start_index < 0:
+                    raise Exception("negative times are not supported")
+                end_index = start_index + sound.length(Fs)
+                if end_index > buffer.shape[1]:
+                    buffer = np.hstack(
+                        (buffer, np.zeros((2, end_index - buffer.shape[1])))
+                    )
+                gains = tuple(sign * gain for gain in sound.channel_gains)
+                sound.add_into(buffer, start_index, gains, Fs)
+                ranges.append((start_index, end_index))
+
+        length = max(
+            (
+                sound.start_index(Fs) + sound.length(Fs) - offset_index
+                for sound in self.sounds
+            ),
+            default=0,
+        )
+        if length < buffer.shape[1]:
+            buffer = buffer[:, :length].copy()
+
+        self._rendered = (offset, Fs, buffer)
+        self._added, self._removed = [], []
+        return buffer, _merge_ranges(ranges, length)
+
     def delayed(self, offset):
         result = Stream()
         for sound in self.sounds:
             result.add_sound(sound.delayed(offset))
         return result
 
+    def quantized(self, Fs=Fs):
+        """A copy of the stream with every sound on integer sample positions"""
+        result = Stream()
+        for sound in self.sounds:
+            result.add_sound(sound.quantized(Fs))
+        return result
+
     @staticmethod
     def chunk_ordered_sounds(sounds, length_break=4):
+        """
+        Groups ordered sounds into chunks at least length_break long. If
+        length_break is a ChunkLengthController, its current length is used
+        for each chunk.
+        """
         chunk = Stream()
-        for _, chord in itertools.groupby(
-            sounds, key=lambda sound: sound.start
-        ):
+        for _, chord in itertools.groupby(sounds, key=start_index_of):
             for sound in chord:
                 chunk.add_sound(sound)
 
-            if chunk.duration >= length_break:
+            if chunk.duration >= chunk_target_length(length_break):
                 yield chunk
                 chunk = Stream()
 
@@ -72,38 +414,230 @@ class Stream(object):
             yield chunk
 
     @staticmethod
-    def play_streams(streams):
+    def play_streams(
+        streams,
+        Fs=Fs,
+        render_Fs=None,
+        clock=None,
+        controller=None,
+        profiler=None,
+    ):
+        """
+        Plays chunks at the sink rate Fs. If render_Fs is given, the chunks
+        are synthesized at that rate and resampled to Fs just before playback.
+        Each chunk is started at the sample position of its offset on the
+        clock, which can be passed in to monitor drift. The time taken to
+        render and start each chunk is reported to the controller, if any,
+        and the render, encode, wait and play steps are timed by the profiler.
+        """
+        if render_Fs is None:
+            render_Fs = Fs
+        if clock is None:
+            clock = PlaybackClock(Fs)
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+
         offset = 0
 
-        deadline = None
         audio_cleanup = None
         for stream in streams:
-            waveform = stream.waveform(offset)
+            render_started = time.perf_counter()
+            with profiler.step("render"):
+                if stream.is_centered:
+                    waveform = resample(
+                        stream.waveform(offset, render_Fs), render_Fs, Fs
+                    )
+                    left, right = waveform, waveform
+                else:
+                    left, right = resample(
+                        stream.stereo_waveform(offset, render_Fs),
+                        render_Fs,
+                        Fs,
+                    )
+            with profiler.step("encode"):
+                filename = write_temporary_sound(left, right, Fs)
             max_start = stream.max_start
+            render_seconds = time.perf_counter() - render_started
 
             if audio_cleanup is not None:
                 audio_cleanup()
 
-            if deadline is not None:
-                time_left = deadline - time.monotonic()
-                if (time_left) < 1:
-                    print("less than one second left to wait")
-                if time_left > 0:
-                    time.sleep(time_left)
+            position = round(offset * Fs)
+            with profiler.step("wait"):
+                if clock.started:
+                    time_left = clock.wait_until(position)
+                    if (time_left) < 1:
+                        print("less than one second left to wait")
+                else:
+                    clock.start(position)
             # NOTE: we want to do the most we can between starting the playback
             # and sleeping. So there should be a minimum of code right here.
-            audio_cleanup = play_sound_asynchronously(waveform, waveform)
+            play_started = time.perf_counter()
+            with profiler.step("play"):
+                audio_cleanup = play_sound_file(filename)
+            clock.mark(position)
+
+            if controller is not None:
+                render_seconds += time.perf_counter() - play_started
+                controller.observe(stream.duration, render_seconds)
 
-            deadline = time.monotonic() + max_start - offset
             offset = max_start
 
 
-def chunk_and_play(sounds, length_break=4):
+def chunk_and_play(
+    sounds,
+    length_break=4,
+    polyphony=None,
+    quality="full",
+    Fs=Fs,
+    profiler=None,
+):
+    """
+    Plays ordered sounds in chunks. length_break is either a fixed chunk
+    length in seconds or a ChunkLengthController to adapt it as we go.
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+
+    if polyphony is not None:
+        sounds = profiler.stage(polyphony.limit, "polyphony")(sounds)
+
+    controller = None
+    if isinstance(length_break, ChunkLengthController):
+        controller = length_break
+
+    chunk = functools.partial(
+        Stream.chunk_ordered_sounds, length_break=length_break
+    )
     Stream.play_streams(
-        Stream.chunk_ordered_sounds(sounds, length_break=length_break)
+        profiler.stage(chunk)(sounds),
+        Fs=Fs,
+        render_Fs=render_rate(quality, Fs),
+        controller=controller,
+        profiler=profiler,
     )
 
 
+class StreamView(object):
+    """
+    A stream shifted later by offset and optionally stretched in time by
+    scale (around time zero), without copying its sounds. Sounds are shifted
+    one at a time as they are pulled from stream, and an unstretched view
+    renders its waveforms straight from the stream it wraps. With a timebase
+    the offset is a whole number of samples at that rate.
+
+    A view follows any changes made to the stream it wraps.
+    """
+
+    def __init__(self, stream, offset=0, scale=1, timebase=None):
+        if scale <= 0:
+            raise ValueError("scale must be positive")
+
+        # views of views collapse into a single view of the underlying stream
+        if isinstance(stream, StreamView) and stream.timebase == timebase:
+            offset = stream._offset * scale + offset
+            if timebase is not None:
+                offset = round(offset)
+            scale = stream.scale * scale
+            stream = stream.base
+
+        self._stream = stream
+        self._offset = offset
+        self._scale = scale
+        self._timebase = timebase
+
+    @property
+    def base(self):
+        return self._stream
+
+    @property
+    def offset(self):
+        """The shift in seconds"""
+        if self._timebase is None:
+            return self._offset
+        return self._offset / self._timebase
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @property
+    def timebase(self):
+        return self._timebase
+
+    def _shift(self, t):
+        return t * self.scale + self.offset
+
+    def _transform(self, sound):
+        c = sound.copy()
+        if self.scale != 1:
+            c.delay(c.start * (self.scale - 1))
+            c.stretch(self.scale)
+        if self._timebase is None:
+            c.delay(self._offset)
+        else:
+            c.delay_samples(self._offset, self._timebase)
+        return c
+
+    @property
+    def sounds(self):
+        return set(self.stream)
+
+    @property
+    def is_empty(self):
+        return self._stream.is_empty
+
+    @property
+    def min_start(self):
+        return self._shift(self._stream.min_start)
+
+    @property
+    def max_start(self):
+        return self._shift(self._stream.max_start)
+
+    @property
+    def max_end(self):
+        return self._shift(self._stream.max_end)
+
+    @property
+    def duration(self):
+        return self.max_end - self.min_start
+
+    @property
+    def is_centered(self):
+        return self._stream.is_centered
+
+    @property
+    def stream(self):
+        for sound in self._stream.stream:
+            yield self._transform(sound)
+
+    def materialize(self):
+        """A Stream holding shifted copies of the sounds"""
+        result = Stream()
+        for sound in self.stream:
+            result.add_sound(sound)
+        return result
+
+    def waveform(self, offset=0, Fs=Fs):
+        if self.scale != 1:
+            return self.materialize().waveform(offset, Fs)
+        return self._stream.waveform(offset - self.offset, Fs)
+
+    def stereo_waveform(self, offset=0, Fs=Fs):
+        if self.scale != 1:
+            return self.materialize().stereo_waveform(offset, Fs)
+        return self._stream.stereo_waveform(offset - self.offset, Fs)
+
+    def delayed(self, offset):
+        if self._timebase is not None:
+            offset = round(offset * self._timebase)
+        return StreamView(self, offset, timebase=self._timebase)
+
+    def stretched(self, scale):
+        return StreamView(self, 0, scale, self._timebase)
+
+
 def make_loop_and_tap():
     class Store(object):
         def __init__(self):
@@ -113,7 +647,7 @@ def make_loop_and_tap():
             self._stream.add_sound(sound)
 
         def return_and_reset(self):
-            result = self._stream.deplayed(self._stream.duration)
+            result = StreamView(self._stream, self._stream.duration)
             self._stream = Stream()
             return result
 
@@ -123,7 +657,7 @@ def make_loop_and_tap():
         while loops > 0:
             loops -= 1
             yield from sounds
-            sounds = store.return_and_reset().deplayed(gap).stream
+            sounds = store.return_and_reset().delayed(gap).stream
 
     def tap(sounds):
         for sound in sounds:
@@ -138,17 +672,109 @@ def simple_loop(sounds, loops=float("inf"), gap=0):
     yield from tap(loop(sounds, loops, gap))
 
 
-def window_sort(sounds, window):
-    """Ensure that sounds are ordered within a window of seconds"""
+def _same_sound(a, b):
+    # transforms like in_place ones return a copy even when they change
+    # nothing
+    return a is b or (type(a) is type(b) and a.render_key == b.render_key)
 
-    buffer = []
+
+def render_once_loop(
+    sounds, loops=float("inf"), gap=0, transform=None, Fs=Fs
+):
+    """
+    Loops ordered sounds like simple_loop, but the first pass is rendered
+    once and later passes replay the cached buffer. If a transform (a function
+    from one sound to another) is given it is applied to every sound on every
+    pass; sounds it returns unchanged (the same sound, or a copy equal to it)
+    stay in the cached buffer and only the ones it actually changes come out
+    to be synthesized again.
+    """
+    if transform is None:
+        transform = lambda sound: sound
+
+    iteration = Stream()
     for sound in sounds:
-        buffer.append(sound)
-        buffer.sort(key=lambda sound: sound.start)
-        while buffer[-1].start - buffer[0].start > window:
-            yield buffer.pop(0)
+        iteration.add_sound(sound)
+        yield transform(sound)
+    loops -= 1
+
+    if iteration.is_empty:
+        return
+
+    originals = list(iteration.stream)
+    period = iteration.duration + gap
+    shift = 0
+
+    cached_for, cached = None, []
+    while loops > 0:
+        loops -= 1
+        shift += period
+
+        unchanged, changed = [], []
+        for sound in originals:
+            transformed = transform(sound)
+            if _same_sound(transformed, sound):
+                unchanged.append(sound)
+            else:
+                changed.append(transformed)
+
+        if cached_for != [id(sound) for sound in unchanged]:
+            cached_for = [id(sound) for sound in unchanged]
+            cached = []
+            if unchanged:
+                bed = Stream()
+                for sound in unchanged:
+                    bed.add_sound(sound)
+                cached = bed.recorded(Fs)
+
+        yield from sorted(
+            (
+                sound.delayed(shift)
+                for sound in itertools.chain(cached, changed)
+            ),
+            key=start_index_of,
+        )
+
+
+class WindowSorter(object):
+    """
+    Puts back in order sounds that arrive out of order by at most a window
+    of seconds. Each sound pushed in returns the sounds that can no longer
+    be overtaken, and flush returns the rest once there are no more.
+    """
+
+    def __init__(self, window, Fs=Fs):
+        self._window = window * Fs
+        # a heap of (start index, arrival, sound) keeps equal starts in
+        # arrival order
+        self._buffer = []
+        self._arrivals = itertools.count()
+        self._latest = None
 
-    yield from buffer
+    def push(self, sound):
+        start = start_index_of(sound)
+        heapq.heappush(self._buffer, (start, next(self._arrivals), sound))
+        if self._latest is None or start > self._latest:
+            self._latest = start
+
+        ready = []
+        while self._latest - self._buffer[0][0] > self._window:
+            ready.append(heapq.heappop(self._buffer)[2])
+        return ready
+
+    def flush(self):
+        ready = []
+        while self._buffer:
+            ready.append(heapq.heappop(self._buffer)[2])
+        return ready
+
+
+def window_sort(sounds, window):
+    """Ensure that sounds are ordered within a window of seconds"""
+    sorter = WindowSorter(window)
+    for sound in sounds:
+        yield from sorter.push(sound)
+    yield from sorter.flush()
 
 
 def ensure_positive(sounds):
@@ -167,6 +793,94 @@ def ensure_positive(sounds):
         yield sound.delayed(offset)
 
 
+class PolyphonyLimiter(object):
+    """
+    Caps the number of simultaneously sounding voices in a stream of ordered
+    sounds. When a new sound would exceed the cap, an active voice is chosen
+    by the steal policy and cut off at the start of the new sound (or dropped
+    entirely if it starts at the same time).
+    """
+
+    POLICIES = {
+        "oldest": lambda sound: sound.start,
+        "quietest": lambda sound: sound.volume,
+    }
+
+    def __init__(self, max_voices, policy="oldest"):
+        if max_voices < 1:
+            raise ValueError("max_voices must be at least one")
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown voice stealing policy: {policy}")
+
+        self._max_voices = max_voices
+        self._policy = policy
+        self._stolen_voices = 0
+        self._dropped_voices = 0
+
+    @property
+    def max_voices(self):
+        return self._max_voices
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def stolen_voices(self):
+        """Voices that were cut short to make room for a newer sound"""
+        return self._stolen_voices
+
+    @property
+    def dropped_voices(self):
+        """Voices that were stolen before they got to sound at all"""
+        return self._dropped_voices
+
+    def limit(self, sounds):
+        steal_key = self.POLICIES[self.policy]
+
+        # sounds are held back until nothing can shorten them any more, and
+        # then released in their original order
+        pending = []
+        active = []
+        final = set()
+
+        for sound in sounds:
+            still_active = []
+            for voice in active:
+                if voice.end <= sound.start:
+                    final.add(id(voice))
+                else:
+                    still_active.append(voice)
+            active = still_active
+
+            while len(active) >= self.max_voices:
+                victim = min(active, key=steal_key)
+                active.remove(victim)
+                self._stolen_voices += 1
+
+                index = next(
+                    i for i, held in enumerate(pending) if held is victim
+                )
+                if victim.start >= sound.start:
+                    self._dropped_voices += 1
+                    del pending[index]
+                else:
+                    cut = victim.stretched(
+                        (sound.start - victim.start) / victim.duration
+                    )
+                    pending[index] = cut
+                    final.add(id(cut))
+
+            active.append(sound)
+            pending.append(sound)
+
+            while pending and id(pending[0]) in final:
+                final.discard(id(pending[0]))
+                yield pending.pop(0)
+
+        yield from pending
+
+
 def log_sounds(sounds):
     for sound in sounds:
         print(sound)
@@ -174,6 +888,8 @@ def log_sounds(sounds):
 
 
 if __name__ == "__main__":
+    import random
+
     s = Stream()
     s.add_sound(
         Tone(
@@ -242,3 +958,14 @@ if __name__ == "__main__":
         itertools.islice(simple_loop(s.stream, loops=float("inf"), gap=0.5), 20)
     )
 
+    print("rendered once, with the top note drifting")
+
+    def drift(sound):
+        # a copy either way, but only the 880Hz tone is ever changed
+        ratio = random.choice([1, 1.01]) if sound.frequency == 880 else 1
+        return sound.detuned(lambda frequency: frequency * ratio)
+
+    chunk_and_play(
+        render_once_loop(s.stream, loops=4, gap=0.5, transform=drift)
+    )
+
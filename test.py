@@ -4,6 +4,7 @@ import numpy as np
 import itertools
 import tempfile
 import os
+import bisect
 
 Fs = 44100
 
@@ -147,7 +148,15 @@ class Note(object):
 
 class Piece(object):
     def __init__(self, *notes):
-        self._notes = set(notes) if notes else set()
+        self._notes = set()
+        # notes grouped into chords by start time, with the starts kept in
+        # order and the longest note of each chord, so that the extents of
+        # the piece never need a sort
+        self._chords = {}
+        self._starts = []
+        self._chord_lengths = {}
+        for note in notes:
+            self.add_note(note)
 
     @property
     def notes(self):
@@ -155,45 +164,53 @@ class Piece(object):
 
     @property
     def notes_in_order(self):
-        yield from sorted(self.notes, key=lambda note: note.start)
+        for chord in self.chords_in_order:
+            yield from chord
 
     @property
     def chords_in_order(self):
-        def note_start(note):
-            return note.start
-
-        for _, g in itertools.groupby(
-            sorted(self.notes, key=note_start), key=note_start
-        ):
-            yield set(g)
+        for start in self._starts:
+            yield set(self._chords[start])
 
     @property
     def first_start(self):
-        if not self.notes:
+        if not self._starts:
             return 0
 
-        return next(self.chords_in_order).pop().start
+        return self._starts[0]
 
     @property
     def last_start(self):
-        if not self.notes:
+        if not self._starts:
             return 0
 
-        return list(self.chords_in_order)[-1].pop().start
+        return self._starts[-1]
 
     @property
     def total_length(self):
-        if not self.notes:
+        if not self._starts:
             return 0
 
-        last_group = list(self.chords_in_order)[-1]
-        return (
-            max(note.duration for note in last_group) + last_group.pop().start
-        )
+        return self._chord_lengths[self.last_start] + self.last_start
 
     def add_note(self, note):
+        if note in self._notes:
+            return
         self._notes.add(note)
 
+        start = note.start
+        if start not in self._chords:
+            self._chords[start] = set()
+            self._chord_lengths[start] = note.duration
+            if not self._starts or start > self._starts[-1]:
+                self._starts.append(start)
+            else:
+                bisect.insort(self._starts, start)
+        self._chords[start].add(note)
+        self._chord_lengths[start] = max(
+            self._chord_lengths[start], note.duration
+        )
+
     def subpieces(self, length_break=7, forever=False):
         group = None
         while True:
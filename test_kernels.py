@@ -0,0 +1,9 @@
+import pytest
+
+pytest.importorskip("numba")
+
+import kernels
+
+
+def test_numba_kernels_match_numpy():
+    assert kernels.check_kernels() < 1e-8
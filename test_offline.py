@@ -0,0 +1,14 @@
+import wave
+
+from offline import MemmapMix
+from sounds import Tone
+
+
+def test_written_frames_match_the_mix(tmp_path):
+    filename = str(tmp_path / "mix.wav")
+    with MemmapMix(initial_length=1) as mix:
+        mix.add_sound(Tone(0, 1.3, 440, [], 0.5, 0.1, 0.1, 0.5, 0.1))
+        mix.write_sound(filename, bits_per_sample=16, block_length=1)
+
+        with wave.open(filename, "rb") as f:
+            assert f.getnframes() == mix.frames